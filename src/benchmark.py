@@ -0,0 +1,185 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tracemalloc
+
+# The benchmark runs the whole pipeline against local fakes. It keeps its journal, caches and downloads in its own
+# directory and never uses the real Drive folders, OpenAI key or Etsy shop, whatever config.env says.
+# These have to be set before the pipeline modules are imported because they read them at import time
+BENCHMARK_DIR = os.path.abspath(os.getenv("BENCHMARK_DIR", "benchmark_run"))
+os.environ.update({
+    'UNPROCESSED_FOLDER_ID': 'benchmark-unprocessed',
+    'PROCESSED_FOLDER_ID': 'benchmark-processed',
+    'ETSY_API_KEY': 'benchmark',
+    'ETSY_SHOP_ID': 'benchmark-shop',
+    'OPENAI_API_KEY': 'benchmark',
+    'METRICS_ENABLED': 'true',
+    'METRICS_LOG_FILE': os.path.join(BENCHMARK_DIR, 'metrics.jsonl'),
+    'METRICS_PROM_FILE': os.path.join(BENCHMARK_DIR, 'listing_agent.prom'),
+    'JOB_JOURNAL_FILE': os.path.join(BENCHMARK_DIR, 'job_journal.db'),
+    'LISTING_CACHE_DIR': os.path.join(BENCHMARK_DIR, 'listing_cache'),
+    'GPT_RENDITION_CACHE_DIR': os.path.join(BENCHMARK_DIR, 'gpt_image_renditions'),
+    'IMAGE_STORE_DIR': os.path.join(BENCHMARK_DIR, 'image_store')
+})
+# The real Etsy limit of 5 requests per second would hide everything else, so allow a much higher rate unless one is set
+os.environ.setdefault('ETSY_REQUESTS_PER_SECOND', '1000')
+os.environ.setdefault('ETSY_REQUESTS_PER_DAY', '100000000')
+
+import openai
+import metrics
+import job_journal
+import etsy_processor
+import drive_watcher
+from gpt_scheduler import get_gpt_scheduler
+from drive_authentication import set_drive_service_factory
+from fake_drive_service import FakeDriveService
+from fake_etsy_server import start_fake_etsy_server
+from fake_openai_server import start_fake_openai_server
+
+# Pillow is only needed to make real JPEG test images
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Stages reported in the latency table, in pipeline order
+REPORTED_STAGES = ['drive_listing', 'drive_download', 'drive_thumbnail', 'gpt_first_token', 'gpt_first_field', 'gpt_generate',
+                   'etsy_upload', 'etsy_create_listing', 'etsy_associate_image', 'publish_prepare', 'publish', 'drive_move', 'drive_bulk_move', 'product']
+
+# Make one test image whose longest side is size pixels, with a 4:3 shape.
+# Random pixels keep the JPEG about as big as a real photo of that size
+def make_test_image(size):
+    width, height = size, max(1, size * 3 // 4)
+    if Image is None:
+        # Without Pillow, a JPEG header followed by roughly a photo's worth of bytes
+        return b'\xff\xd8\xff\xe0' + os.urandom(width * height // 2) + b'\xff\xd9', width, height
+    image = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=90)
+    return output.getvalue(), width, height
+
+# Remove everything the previous run left behind, so each run starts with an empty journal and cold caches
+def reset_benchmark_dir():
+    # The journal keeps its connections open, so close them before its files are deleted
+    job_journal.reset_journal()
+    for name in ('job_journal.db', 'job_journal.db-wal', 'job_journal.db-shm', 'listing_cache', 'gpt_image_renditions', 'downloaded_images_etsy', 'image_store', 'metrics.jsonl'):
+        path = os.path.join(BENCHMARK_DIR, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+    metrics.reset_metrics()
+
+# Run drive_watcher in batch mode over one backlog and return its numbers
+def run_benchmark(drive, backlog_size, image_size, images_per_folder, workers):
+    reset_benchmark_dir()
+    image_data, width, height = make_test_image(image_size)
+    drive.load_backlog(os.environ['UNPROCESSED_FOLDER_ID'], backlog_size, images_per_folder, image_data, width, height)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    results = drive_watcher.drive_watcher_batch(max_workers=workers)
+    elapsed = time.perf_counter() - start_time
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    succeeded = len([result for result in results if result['success']])
+    # Folders another instance held a lease on were not ours to process, so they are not failures
+    skipped = len([result for result in results if result.get('skipped')])
+    stage_latencies = {}
+    for stage in REPORTED_STAGES:
+        p50 = metrics.stage_percentile(stage, 50)
+        if p50 is not None:
+            stage_latencies[stage] = {
+                'p50': p50,
+                'p95': metrics.stage_percentile(stage, 95),
+                'p99': metrics.stage_percentile(stage, 99)
+            }
+    return {
+        'backlog_size': backlog_size,
+        'image_size': image_size,
+        'image_bytes': len(image_data),
+        'images_per_folder': images_per_folder,
+        'workers': workers,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded - skipped,
+        'skipped': skipped,
+        'seconds': elapsed,
+        'items_per_second': succeeded / elapsed if elapsed > 0 else 0.0,
+        'peak_memory_bytes': peak_memory,
+        'drive_api_calls': drive.api_calls,
+        'gpt_tokens_per_minute': get_gpt_scheduler().stats()['tokens_per_minute'],
+        'gpt_retries': sum(stats['retries'] for (stage, outcome), stats in metrics.get_stage_stats().items() if stage == 'gpt_generate'),
+        'stages': stage_latencies
+    }
+
+# Print one run as a short report
+def print_report(report, output):
+    output.write(f"\n=== Backlog {report['backlog_size']}, image {report['image_size']}px "
+                 f"({report['image_bytes'] / 1024:.0f} KB), {report['images_per_folder']} image(s) per folder, "
+                 f"{report['workers']} worker(s) ===\n")
+    output.write(f"Succeeded: {report['succeeded']}  Failed: {report['failed']}  Leased elsewhere: {report['skipped']}  "
+                 f"Time: {report['seconds']:.2f} s  Items/sec: {report['items_per_second']:.2f}\n")
+    output.write(f"Peak traced memory: {report['peak_memory_bytes'] / (1024 * 1024):.1f} MB  "
+                 f"Drive API calls: {report['drive_api_calls']}\n")
+    output.write(f"GPT tokens admitted in the last minute: {report['gpt_tokens_per_minute']}  GPT retries: {report['gpt_retries']}\n")
+    output.write(f"{'stage':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}\n")
+    for stage, latency in report['stages'].items():
+        output.write(f"{stage:<22}{latency['p50'] * 1000:>10.1f}{latency['p95'] * 1000:>10.1f}{latency['p99'] * 1000:>10.1f}\n")
+
+# Turn "10,100" into [10, 100]
+def parse_sizes(text):
+    return [int(part) for part in text.split(',') if part.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the listing pipeline end to end against local fakes of Drive, OpenAI and Etsy")
+    parser.add_argument("--backlogs", default="10,50", help="comma separated numbers of product folders to run")
+    parser.add_argument("--image-sizes", default="1024,3000", help="comma separated longest image sides in pixels")
+    parser.add_argument("--images-per-folder", type=int, default=1, help="images in every product folder")
+    parser.add_argument("--workers", type=int, default=drive_watcher.WORKER_COUNT, help="product folders processed at once")
+    parser.add_argument("--drive-latency", type=float, default=0.05, help="seconds added to every fake Drive call")
+    parser.add_argument("--drive-bandwidth", type=float, default=50.0, help="fake Drive download speed in MB/s, 0 for unlimited")
+    parser.add_argument("--gpt-latency", type=float, default=2.0, help="seconds every fake GPT call takes")
+    parser.add_argument("--gpt-bad-rate", type=float, default=0.0, help="share of fake GPT answers with the wrong tag count")
+    parser.add_argument("--gpt-rpm-limit", type=int, default=0, help="requests per minute the fake OpenAI server allows before answering 429, 0 for no limit")
+    parser.add_argument("--etsy-latency", type=float, default=0.1, help="seconds every fake Etsy call takes")
+    parser.add_argument("--json", help="also write every report to this JSON file")
+    args = parser.parse_args()
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    # Downloads go to a relative folder, so keep them inside the benchmark directory
+    os.chdir(BENCHMARK_DIR)
+
+    drive = FakeDriveService(latency_seconds=args.drive_latency, bytes_per_second=args.drive_bandwidth * 1024 * 1024)
+    set_drive_service_factory(lambda: drive)
+    etsy_server, etsy_base_url = start_fake_etsy_server(delay_seconds=args.etsy_latency)
+    openai_server, openai_base_url = start_fake_openai_server(chat_delay_seconds=args.gpt_latency, bad_response_rate=args.gpt_bad_rate,
+                                                              requests_per_minute=args.gpt_rpm_limit)
+    etsy_processor.ETSY_API_BASE = etsy_base_url
+    openai.api_base = openai_base_url
+    openai.api_key = 'benchmark'
+
+    reports = []
+    try:
+        for image_size in parse_sizes(args.image_sizes):
+            for backlog_size in parse_sizes(args.backlogs):
+                reports.append(run_benchmark(drive, backlog_size, image_size, args.images_per_folder, max(1, args.workers)))
+    finally:
+        set_drive_service_factory(None)
+        etsy_server.shutdown()
+        openai_server.shutdown()
+
+    # The pipeline prints a lot while it runs, so the reports all come at the end
+    for report in reports:
+        print_report(report, sys.stdout)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(reports, json_file, indent=2)
+        print("\nReports written to:", os.path.abspath(args.json))
+
+if __name__ == "__main__":
+    main()
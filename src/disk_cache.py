@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+# Write bytes to a file through a temp file so readers never see a half written file.
+# Every call gets its own temp file in the same folder, so several threads can write the same path at once
+def write_file_atomically(path, data):
+    directory = os.path.dirname(path) or '.'
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+# Mark a cached file as just used so it is the last one to be evicted
+def touch_file(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+# Delete the least recently used files in a cache folder until its total size is at most max_bytes.
+# Paths in keep are never deleted, e.g. the file that was just added
+def evict_oldest_files(directory, max_bytes, keep=()):
+    try:
+        if not os.path.exists(directory):
+            return
+        entries = []
+        total_size = 0
+        for entry_name in os.listdir(directory):
+            entry_path = os.path.join(directory, entry_name)
+            # Temp files of writes still in progress are not cache entries
+            if entry_name.endswith('.tmp'):
+                continue
+            if os.path.isfile(entry_path):
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size = total_size + stat.st_size
+
+        # Oldest files go first
+        entries.sort()
+        for mtime, size, entry_path in entries:
+            if total_size <= max_bytes:
+                break
+            if entry_path in keep:
+                continue
+            os.remove(entry_path)
+            total_size = total_size - size
+            print("Evicted cached file:", entry_path)
+    except Exception as e:
+        print("Error in evict_oldest_files:", e)
@@ -2,9 +2,16 @@
 from googleapiclient.http import MediaIoBaseDownload
 import io
 import os
+import re
 import shutil
+import hashlib
+from image_buffer import ImageBuffer
+from image_store import get_stored_image, new_incoming_path, partial_download_path, HashingFileWriter, add_to_store
+from metrics import timed_stage, current_span
+from ranged_download import RANGED_DOWNLOAD_MIN_BYTES, download_file_in_ranges, get_partial_lock
 
 # This downloads a file from google drive to the local machine
+@timed_stage('drive_download', count_bytes=lambda args, result: os.path.getsize(result[0]))
 def download_file(service, file_id, file_name, product_folder_name):
     fh = None
     try:
@@ -71,6 +78,136 @@ def download_file(service, file_id, file_name, product_folder_name):
         return None, None
 
 
+# Download a file from google drive into the local image store, keyed by its Drive md5Checksum.
+# If the store already has it nothing is downloaded. The download is checked against the checksum before it is stored.
+# Files of at least RANGED_DOWNLOAD_MIN_BYTES (when Drive told us the size) are fetched in parallel ranges and
+# resume after an interruption. Returns the stored path, or None if the download failed or did not match
+@timed_stage('drive_download')
+def download_file_to_store(service, file_id, file_name, md5_checksum, file_size=None):
+    writer = None
+    incoming_path = None
+    try:
+        stored_path = get_stored_image(md5_checksum, file_name)
+        if stored_path is not None:
+            print("Using stored copy of:", file_name)
+            # Only labelled once the stored file was found and touched, so a failed call is never a store hit
+            current_span().set_outcome("store_hit")
+            return stored_path
+
+        if file_size is not None and int(file_size) >= RANGED_DOWNLOAD_MIN_BYTES:
+            print("Starting ranged download to the image store for:", file_name)
+            partial_path = partial_download_path(md5_checksum)
+            # The same image can sit in two product folders. Whoever gets the lock second finds it in the store
+            # instead of starting over on a partial file that was already moved into the store
+            with get_partial_lock(partial_path):
+                stored_path = get_stored_image(md5_checksum, file_name)
+                if stored_path is not None:
+                    print("Using stored copy of:", file_name)
+                    current_span().set_outcome("store_hit")
+                    return stored_path
+                actual_md5 = download_file_in_ranges(file_id, file_name, int(file_size), partial_path)
+                if actual_md5 is None:
+                    # The partial file stays so the next attempt resumes it
+                    return None
+                stored_path = add_to_store(partial_path, actual_md5, md5_checksum, file_name)
+            if stored_path is not None:
+                print("Download complete and checksum verified")
+                current_span().set_outcome("ranged")
+            return stored_path
+
+        print("Starting download to the image store for:", file_name)
+        incoming_path = new_incoming_path()
+        writer = HashingFileWriter(incoming_path)
+        file_request = service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(writer, file_request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+        actual_md5 = writer.md5.hexdigest()
+        writer.close()
+        writer = None
+
+        current_span().add_bytes(os.path.getsize(incoming_path))
+        stored_path = add_to_store(incoming_path, actual_md5, md5_checksum, file_name)
+        incoming_path = None
+        if stored_path is not None:
+            print("Download complete and checksum verified")
+        return stored_path
+    except Exception as e:
+        print("Error in download_file_to_store:", e)
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+        if incoming_path is not None and os.path.exists(incoming_path):
+            os.remove(incoming_path)
+
+
+# Download a file from google drive into an in-memory ImageBuffer instead of the disk.
+# Pass the worker's buffer to reuse its memory, otherwise a new buffer is created.
+# When md5_checksum is given the bytes are checked against it
+@timed_stage('drive_download', count_bytes=lambda args, result: result.size)
+def download_file_to_buffer(service, file_id, file_name, image_buffer=None, md5_checksum=None):
+    try:
+        print("Starting in-memory download for:", file_name)
+        if image_buffer is None:
+            image_buffer = ImageBuffer(file_name)
+        else:
+            image_buffer.reset(file_name)
+
+        # Get the file from Google Drive and stream it into the buffer
+        file_request = service.files().get_media(fileId=file_id)
+        downloader = MediaIoBaseDownload(image_buffer, file_request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+
+        if md5_checksum is not None:
+            with image_buffer.data.getbuffer() as view:
+                actual_md5 = hashlib.md5(view).hexdigest()
+            if actual_md5 != md5_checksum.lower():
+                print("Downloaded file does not match its Drive checksum:", file_name)
+                return None
+
+        print("Download complete. Bytes in memory:", image_buffer.size)
+        return image_buffer
+    except Exception as e:
+        print("Error in download_file_to_buffer:", e)
+        return None
+
+
+# Download a sized Drive thumbnail of an image into an ImageBuffer. size is the longest side in pixels.
+# Returns None if the file has no thumbnail or the request fails
+@timed_stage('drive_thumbnail', count_bytes=lambda args, result: result.size)
+def download_thumbnail(service, image_file, size):
+    try:
+        thumbnail_link = image_file.get('thumbnailLink')
+        if thumbnail_link is None:
+            print("No thumbnail available for:", image_file.get('name'))
+            return None
+
+        # Thumbnail links end with =s220. Ask for the size we want instead
+        if re.search(r'=s\d+$', thumbnail_link):
+            thumbnail_url = re.sub(r'=s\d+$', f'=s{size}', thumbnail_link)
+        else:
+            thumbnail_url = thumbnail_link + f'=s{size}'
+
+        print("Downloading thumbnail for:", image_file.get('name'))
+        # Use the service's authorized connection so the request carries our credentials
+        response, content = service._http.request(thumbnail_url, 'GET')
+        if response.status != 200:
+            print("Thumbnail request failed with status:", response.status)
+            return None
+
+        image_buffer = ImageBuffer(image_file.get('name'))
+        image_buffer.write(content)
+        print("Thumbnail downloaded. Bytes:", image_buffer.size)
+        return image_buffer
+    except Exception as e:
+        print("Error in download_thumbnail:", e)
+        return None
+
+
 # Delete downloaded image files inside the product folder, but keep the directories
 def cleanup_etsy_images_files(safe_folder_name):
     try:
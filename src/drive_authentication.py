@@ -1,7 +1,14 @@
 import os
+import json
+import threading
+import httplib2
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import google_auth_httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
 from googleapiclient.errors import HttpError
+from disk_cache import write_file_atomically
+from token_cache import DRIVE_TOKEN_CACHE_ENABLED, load_cached_token, save_cached_token
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -10,8 +17,124 @@ load_dotenv('config.env')
 # Google Drive API scopes (permissions). Gives me full access to google drive. It allows me to use the service functions
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+# Saved copy of the Drive v3 discovery document. Only used when the installed googleapiclient has no copy of its own
+DRIVE_DISCOVERY_FILE = os.getenv('DRIVE_DISCOVERY_FILE', 'drive_v3_discovery.json')
+DRIVE_DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/drive/v3/rest"
+
+# Most HTTP connections to Drive that are open at the same time. A thread that needs one while all are busy waits
+DRIVE_POOL_SIZE = int(os.getenv("DRIVE_POOL_SIZE", "16"))
+
+# The discovery document is parsed once per process and shared by every Drive service built after that
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+# When set, get_drive_service returns factory() instead of a real service. The benchmark uses this for its fake Drive
+_service_factory = None
+
+# Use factory to build every Drive service from now on, or pass None to go back to the real one
+def set_drive_service_factory(factory):
+    global _service_factory
+    _service_factory = factory
+
+# Get the Drive v3 discovery document without asking Google for it on every run. Uses the copy that ships with
+# googleapiclient, then our saved copy, and only downloads it (and saves it for next time) when neither exists
+def get_discovery_document():
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is not None:
+            return _discovery_document
+
+        from googleapiclient.discovery_cache import get_static_doc
+        document_text = get_static_doc('drive', 'v3')
+        if document_text is None and os.path.exists(DRIVE_DISCOVERY_FILE):
+            with open(DRIVE_DISCOVERY_FILE, 'r', encoding='utf-8') as discovery_file:
+                document_text = discovery_file.read()
+        if document_text is None:
+            print("Downloading the Drive discovery document")
+            response, content = httplib2.Http().request(DRIVE_DISCOVERY_URL, 'GET')
+            if response.status != 200:
+                raise Exception(f"Drive discovery document request failed with status {response.status}")
+            document_text = content.decode('utf-8')
+            write_file_atomically(DRIVE_DISCOVERY_FILE, content)
+
+        _discovery_document = json.loads(document_text)
+        return _discovery_document
+
+# Stands in for the httplib2.Http a Drive service sends its requests through. httplib2 is not thread safe, so every
+# request borrows an authorized connection of its own for just that call and gives it back afterwards.
+# That makes one Drive service safe to use from any number of threads at once, including media downloads and
+# batch requests. Connections stay open between requests and all of them share one credentials object,
+# so the access token is fetched and refreshed once for the whole process
+class DriveHttpPool:
+    def __init__(self, credentials, max_size=DRIVE_POOL_SIZE):
+        self.credentials = credentials
+        self.max_size = max(1, max_size)
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition()
+
+    # Take an idle connection, open a new one while below max_size, or wait for one to come back
+    def checkout(self):
+        with self.condition:
+            while True:
+                if self.idle:
+                    # The most recently used connection is the one most likely to still be open
+                    return self.idle.pop()
+                if self.created < self.max_size:
+                    self.created = self.created + 1
+                    break
+                self.condition.wait()
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=build_http())
+
+    def checkin(self, http):
+        with self.condition:
+            self.idle.append(http)
+            self.condition.notify()
+
+    # Same arguments as httplib2.Http.request
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        http = self.checkout()
+        try:
+            return http.request(uri, method, body=body, headers=headers, **kwargs)
+        finally:
+            self.checkin(http)
+
+    def close(self):
+        with self.condition:
+            for http in self.idle:
+                http.close()
+
+# Build a Drive v3 service for the given credentials from the shared discovery document.
+# It sends its requests through a DriveHttpPool, so it can be shared by every thread.
+# api_endpoint points it at another server, like the fake Drive the pool benchmark runs
+def build_drive_service(credentials, pool_size=DRIVE_POOL_SIZE, api_endpoint=None):
+    client_options = {'api_endpoint': api_endpoint} if api_endpoint is not None else None
+    return build_from_document(get_discovery_document(), http=DriveHttpPool(credentials, pool_size), client_options=client_options)
+
+# Service account credentials that save every new access token to the token cache, so the next run can reuse it.
+# google-auth calls refresh whenever the token is missing or about to expire, so long runs keep the cache fresh too
+class CachedTokenCredentials(service_account.Credentials):
+    def refresh(self, request):
+        super().refresh(request)
+        save_cached_token(self.service_account_email, self.scopes, self.token, self.expiry)
+
+# Create credentials from the service account key file. With the token cache on, a saved token that is still
+# good is loaded into them, so no token exchange happens until it gets close to expiry
+def load_credentials(service_account_file):
+    if not DRIVE_TOKEN_CACHE_ENABLED:
+        return service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
+
+    credentials = CachedTokenCredentials.from_service_account_file(service_account_file, scopes=SCOPES)
+    cached = load_cached_token(credentials.service_account_email, credentials.scopes)
+    if cached is not None:
+        credentials.token, credentials.expiry = cached
+        print("Using cached Drive access token")
+    return credentials
+
 # Authenticate with Google Drive using service account.
 def get_drive_service():
+    if _service_factory is not None:
+        return _service_factory()
     try:
         print("Starting Google Drive authentication")
         
@@ -25,12 +148,11 @@ def get_drive_service():
             return None
         
         # Create credentials from the service account key file (Authentication part)
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_file, scopes=SCOPES)
+        credentials = load_credentials(service_account_file)
         print("Credentials created")
         
         # Build the Google Drive service (Service creation part)
-        service = build('drive', 'v3', credentials=credentials)
+        service = build_drive_service(credentials)
         print("Google Drive service created")
         
         return service
@@ -39,6 +161,21 @@ def get_drive_service():
         print("Error in get_drive_service:", e)
         return None
 
+# The Drive service every thread shares
+_shared_service = None
+_shared_service_lock = threading.Lock()
+
+# Get the Drive service shared by the whole process. It is built the first time and can be used from any thread,
+# because each of its requests runs on its own pooled connection. Returns None if authentication failed
+def get_shared_drive_service():
+    global _shared_service
+    if _service_factory is not None:
+        return _service_factory()
+    with _shared_service_lock:
+        if _shared_service is None:
+            _shared_service = get_drive_service()
+        return _shared_service
+
 # Test the drive authentication
 def test_drive_connection():
     print("Testing Google Drive Authentication")
@@ -0,0 +1,94 @@
+import os
+import json
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# File that keeps the Drive changes cursor between runs
+CHANGES_TOKEN_FILE = os.getenv("CHANGES_TOKEN_FILE", "drive_changes_token.json")
+
+# Only ask Drive for the change fields we use to find product folders
+CHANGE_FIELDS = "nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, parents, trashed))"
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Read the saved changes cursor. Returns None if there is no saved cursor yet
+def load_page_token():
+    try:
+        if not os.path.exists(CHANGES_TOKEN_FILE):
+            return None
+        with open(CHANGES_TOKEN_FILE, 'r') as token_file:
+            data = json.load(token_file)
+        return data.get('page_token')
+    except Exception as e:
+        print("Error in load_page_token:", e)
+        return None
+
+# Save the changes cursor. Writes to a temp file first so a crash never leaves a half written cursor
+def save_page_token(page_token):
+    try:
+        temp_path = CHANGES_TOKEN_FILE + ".tmp"
+        with open(temp_path, 'w') as token_file:
+            json.dump({'page_token': page_token}, token_file)
+        os.replace(temp_path, CHANGES_TOKEN_FILE)
+    except Exception as e:
+        print("Error in save_page_token:", e)
+
+# Ask Drive for a cursor that points at "now"
+def get_start_page_token(service):
+    response = service.changes().getStartPageToken().execute()
+    return response.get('startPageToken')
+
+# Read every change since page_token. Returns the changes and the cursor to use next time
+def list_changes(service, page_token):
+    changes = []
+    new_start_page_token = None
+    while page_token is not None:
+        response = service.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            spaces='drive',
+            fields=CHANGE_FIELDS
+        ).execute()
+        changes.extend(response.get('changes', []))
+        if 'newStartPageToken' in response:
+            new_start_page_token = response['newStartPageToken']
+        page_token = response.get('nextPageToken')
+    return changes, new_start_page_token
+
+# Turn a list of changes into the product folders under the Unprocessed folder that were added or modified.
+# Changes to the folders in ignore_folder_ids themselves are skipped, changes to images inside them still count
+def find_changed_product_folders(service, changes, unprocessed_folder_id, ignore_folder_ids=()):
+    product_folders = {}
+    # Remember folders we already looked up so each parent is fetched only once per poll
+    parent_cache = {}
+
+    for change in changes:
+        changed_file = change.get('file')
+        if change.get('removed') or changed_file is None or changed_file.get('trashed'):
+            continue
+        parents = changed_file.get('parents', [])
+        mime_type = changed_file.get('mimeType', '')
+
+        # A product folder itself was created or renamed
+        if mime_type == FOLDER_MIME_TYPE:
+            if unprocessed_folder_id in parents and changed_file['id'] not in ignore_folder_ids:
+                product_folders[changed_file['id']] = {'id': changed_file['id'], 'name': changed_file['name'], 'parents': [unprocessed_folder_id]}
+            continue
+
+        # An image was added or changed. Check whether its folder is a product folder
+        if mime_type.startswith('image/'):
+            for parent_id in parents:
+                if parent_id not in parent_cache:
+                    # A parent we can not read (not shared with us, or already deleted) is skipped, so one bad
+                    # change never stops the cursor from moving on
+                    try:
+                        parent_cache[parent_id] = service.files().get(fileId=parent_id, fields='id, name, parents').execute()
+                    except Exception as e:
+                        print("Skipping unreadable parent folder", parent_id, ":", e)
+                        parent_cache[parent_id] = None
+                parent = parent_cache[parent_id]
+                if parent is not None and unprocessed_folder_id in parent.get('parents', []):
+                    product_folders[parent_id] = {'id': parent_id, 'name': parent['name'], 'parents': [unprocessed_folder_id]}
+
+    return list(product_folders.values())
@@ -0,0 +1,103 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Shows how Drive work scales with the number of threads when they all share one pooled Drive service.
+# A real googleapiclient service talks HTTP to a local fake Drive, and every product folder is listed, its image
+# downloaded and checked against its MD5, and the folder moved, all from many threads at once.
+# Nothing here touches the real Drive, whatever config.env says
+os.environ['PROCESSED_FOLDER_ID'] = 'benchmark-processed'
+UNPROCESSED_FOLDER_ID = 'benchmark-unprocessed'
+
+from google.auth.credentials import AnonymousCredentials
+from drive_authentication import build_drive_service
+from list_image_files import list_images_in_folders
+from download_file import download_file_to_buffer
+from move_folder_to_processed import move_product_folder_to_processed
+from fake_drive_service import FakeDriveService
+from fake_drive_server import FakeDriveHandler, start_fake_drive_server
+
+# List, download and move one product folder. Returns True if every step worked and the bytes matched
+def process_folder(service, folder):
+    images = list_images_in_folders(service, [folder])
+    if not images:
+        return False
+    image = images[0]
+    image_buffer = download_file_to_buffer(service, image['id'], image['name'], md5_checksum=image['md5Checksum'])
+    if image_buffer is None:
+        return False
+    return move_product_folder_to_processed(service, folder['id'])
+
+# One run with the given number of threads against a freshly loaded fake Drive
+def run_workers(drive, api_endpoint, workers, folder_count, image_data, pool_size):
+    drive.load_backlog(UNPROCESSED_FOLDER_ID, folder_count, 1, image_data, 1024, 768)
+    folders = drive.find_files(f"'{UNPROCESSED_FOLDER_ID}' in parents and mimeType='application/vnd.google-apps.folder'")
+    FakeDriveHandler.connections = 0
+
+    # One service for every thread, with its own connection pool so each run starts cold
+    service = build_drive_service(AnonymousCredentials(), pool_size=pool_size, api_endpoint=api_endpoint)
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda folder: process_folder(service, folder), folders))
+    elapsed = time.perf_counter() - start_time
+
+    moved = len(drive.find_files("'benchmark-processed' in parents"))
+    return {
+        'workers': workers,
+        'seconds': elapsed,
+        'folders_per_second': folder_count / elapsed if elapsed > 0 else 0.0,
+        'succeeded': results.count(True),
+        'failed': results.count(False),
+        'moved': moved,
+        'connections': FakeDriveHandler.connections
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how shared Drive service throughput scales with worker threads")
+    parser.add_argument("--workers", default="1,2,4,8,16", help="comma separated worker thread counts to run")
+    parser.add_argument("--folders", type=int, default=64, help="product folders processed in every run")
+    parser.add_argument("--image-kb", type=int, default=256, help="size of every image in KB")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the fake Drive adds to every call")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="fake Drive download speed in MB/s per request, 0 for unlimited")
+    parser.add_argument("--pool-size", type=int, default=16, help="most open connections of the shared service")
+    parser.add_argument("--min-speedup", type=float, help="fail if the largest worker count is not at least this much faster than the smallest")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    drive = FakeDriveService(latency_seconds=args.latency, bytes_per_second=args.bandwidth * 1024 * 1024)
+    server, api_endpoint = start_fake_drive_server(drive)
+    image_data = b'\xff\xd8\xff\xe0' + os.urandom(args.image_kb * 1024) + b'\xff\xd9'
+
+    reports = []
+    try:
+        for workers in [int(value) for value in args.workers.split(',')]:
+            reports.append(run_workers(drive, api_endpoint, workers, args.folders, image_data, args.pool_size))
+    finally:
+        server.shutdown()
+
+    baseline = reports[0]['seconds']
+    print(f"{'workers':>8} {'seconds':>9} {'folders/s':>10} {'speedup':>8} {'ok':>5} {'failed':>7} {'moved':>6} {'connections':>12}")
+    for report in reports:
+        report['speedup'] = baseline / report['seconds'] if report['seconds'] > 0 else 0.0
+        print(f"{report['workers']:>8} {report['seconds']:>9.2f} {report['folders_per_second']:>10.1f} {report['speedup']:>8.2f} "
+              f"{report['succeeded']:>5} {report['failed']:>7} {report['moved']:>6} {report['connections']:>12}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(reports, json_file, indent=2)
+
+    if any(report['failed'] or report['moved'] != args.folders for report in reports):
+        print("Some folders failed or were not moved")
+        sys.exit(1)
+    if args.min_speedup is not None and reports[-1]['speedup'] < args.min_speedup:
+        print("Speedup", round(reports[-1]['speedup'], 2), "is below", args.min_speedup)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
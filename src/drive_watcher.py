@@ -1,11 +1,12 @@
 import time
 import os
-from list_image_files import list_image_files
-from download_file import download_file, cleanup_etsy_images_files
-from move_folder_to_processed import move_product_folder_to_processed
-from drive_authentication import get_drive_service
-from gpt_processor import generate_etsy_listing_content
-from etsy_processor import create_etsy_draft_listing
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from list_image_files import list_image_files, list_images_in_folders
+from drive_changes import load_page_token, save_page_token, get_start_page_token, list_changes, find_changed_product_folders
+from drive_authentication import get_shared_drive_service
+from metrics import stage_span, write_prometheus_snapshot
+from work_lease import claim_order, claim_product, release_product, lease_writes_since
 from dotenv import load_dotenv
 
 # Load variables from env file
@@ -15,62 +16,50 @@ load_dotenv('config.env')
 UNPROCESSED_FOLDER_ID = os.getenv("UNPROCESSED_FOLDER_ID")
 PROCESSED_FOLDER_ID = os.getenv("PROCESSED_FOLDER_ID")
 
+# How many product folders batch mode works on at the same time
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "4"))
+
+# Daemon mode polls quickly while things are changing and slows down to the max interval when idle
+DAEMON_MIN_INTERVAL = float(os.getenv("DAEMON_MIN_INTERVAL", "15"))
+DAEMON_MAX_INTERVAL = float(os.getenv("DAEMON_MAX_INTERVAL", "300"))
+# Every so often daemon mode does one full rescan to pick up folders that failed earlier. 0 turns it off
+DAEMON_FULL_RESCAN_SECONDS = float(os.getenv("DAEMON_FULL_RESCAN_SECONDS", "3600"))
+
+# The pipeline pulls in OpenAI, requests, Pillow and the Drive media code, which take longer to import than a
+# run with nothing to do takes in total. So product_pipeline is imported inside the functions that need it,
+# and only once there is an image to process
+
 # Single-run watcher: process one image if available, then exit
 def drive_watcher():
     print("Starting drive watcher")
-    # Initialize Google Drive service 
-    service = get_drive_service()
+    # Initialize Google Drive service
+    service = get_shared_drive_service()
     if service is None:
         print("Failed to initialize Google Drive service")
         return
-    
+
     try:
         print("Checking for images in Unprocessed folder")
         image_files = list_image_files(service, UNPROCESSED_FOLDER_ID)
-        
+
         if image_files:
-            print("Images found. Processing first image")
-            file = image_files[0]
-            product_folder_id = file.get('product_folder_id')
-            product_folder_name = file.get('product_folder_name')
-            
-            if product_folder_id is not None and product_folder_name is not None:
-                file_id = file['id']
-                file_name = file['name']
-                
-                download_path, safe_folder_name = download_file(service, file_id, file_name, product_folder_name)
-                
-                if download_path is not None:
-                    print("Image downloaded locally")
-                    listing_data, product_info = generate_etsy_listing_content(download_path, product_folder_name)
-                    
-                    if listing_data is not None and product_info is not None:
-                        print("Received listing content from GPT")
-                        listing_id = create_etsy_draft_listing(listing_data, download_path, product_info)
-                        
-                        if listing_id is not None:
-                            print("Created Etsy draft listing")
-                            move_product_folder_to_processed(service, product_folder_id)
-                            print("Moved product folder to Processed")
-                            cleanup_etsy_images_files(safe_folder_name)
-                            print("Cleaned up local downloaded images")
-                            return
-                        else:
-                            print("Failed to create Etsy draft listing")
-                            cleanup_etsy_images_files(safe_folder_name)
-                            print("Cleaned up local downloaded images")
-                            return
-                    else:
-                        print("Failed to generate listing content from GPT")
-                        cleanup_etsy_images_files(safe_folder_name)
-                        print("Cleaned up local downloaded images")
-                        return
-                else:
-                    print("Failed to download image")
-                    return
-            else:
-                print("Missing product folder information. Exiting")
+            # With leasing on, other instances may be working on some folders, so take the first one we can claim
+            for image_file in claim_order(image_files):
+                if not claim_product(image_file):
+                    continue
+                print("Images found. Processing first image")
+                from product_pipeline import process_product
+                try:
+                    with stage_span('product', product_folder_name=image_file.get('product_folder_name')) as span:
+                        result = process_product(service, image_file)
+                        if not result['success']:
+                            span.set_outcome("failure")
+                finally:
+                    release_product(image_file)
+                write_prometheus_snapshot()
                 return
+            print("Every product folder is leased by another instance")
+            return
         else:
             print("No images found")
             return
@@ -78,5 +67,186 @@ def drive_watcher():
         print("Error in drive_watcher:", e)
         return
 
+# Worker for batch mode. Any error stays inside this product folder so the other folders keep going.
+# The Drive move is left to process_image_files, which moves all finished folders together
+# A folder leased by another instance is skipped. The lease is kept until process_image_files has moved the folder
+def process_product_safely(image_file):
+    from product_pipeline import process_product, make_result
+    if not claim_product(image_file):
+        result = make_result(image_file, False, "leased by another instance")
+        result['skipped'] = True
+        return result
+    try:
+        service = get_shared_drive_service()
+        if service is None:
+            return make_result(image_file, False, "Drive service unavailable")
+        with stage_span('product', product_folder_name=image_file.get('product_folder_name')) as span:
+            result = process_product(service, image_file, defer_move=True)
+            if not result['success']:
+                span.set_outcome("failure")
+        return result
+    except Exception as e:
+        print("Error processing product folder:", e)
+        return make_result(image_file, False, str(e))
+
+# Print the successes and failures at the end of a batch run
+def print_batch_summary(results, elapsed):
+    successes = [r for r in results if r['success']]
+    skipped = [r for r in results if r.get('skipped')]
+    failures = [r for r in results if not r['success'] and not r.get('skipped')]
+    print("Batch finished in", round(elapsed, 1), "seconds")
+    print("Succeeded:", len(successes), "Failed:", len(failures), "Leased by other instances:", len(skipped))
+    for result in failures:
+        print("Failed:", result['product_folder_name'], "-", result['error'])
+
+# Run the given images through the pipeline with a pool of workers, move the finished folders in bulk and print a summary.
+# Leases are released only after the move, so no other instance picks up a finished folder that is still in Unprocessed
+def process_image_files(image_files, max_workers=WORKER_COUNT):
+    from product_pipeline import move_finished_products
+    start_time = time.time()
+    print("Product folders to process:", len(image_files))
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(process_product_safely, image_file) for image_file in claim_order(image_files)]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    service = get_shared_drive_service()
+    if service is not None:
+        move_finished_products(service, image_files, results)
+    release_claimed(image_files, results)
+    print_batch_summary(results, time.time() - start_time)
+    write_prometheus_snapshot()
+    return results
+
+# Release the lease of every product folder that was not skipped
+def release_claimed(image_files, results):
+    skipped_ids = set(result['product_folder_id'] for result in results if result.get('skipped'))
+    for image_file in image_files:
+        if image_file['product_folder_id'] not in skipped_ids:
+            release_product(image_file)
+
+# Batch watcher: process every product folder in Unprocessed with a pool of workers, then exit
+def drive_watcher_batch(max_workers=WORKER_COUNT):
+    print("Starting drive watcher in batch mode with workers:", max_workers)
+    service = get_shared_drive_service()
+    if service is None:
+        print("Failed to initialize Google Drive service")
+        return []
+
+    print("Checking for images in Unprocessed folder")
+    image_files = list_image_files(service, UNPROCESSED_FOLDER_ID)
+    if not image_files:
+        print("No images found")
+        return []
+    return process_image_files(image_files, max_workers)
+
+# Bulk watcher: generate listing content for every product folder with one OpenAI Batch API job,
+# then run the Etsy and Drive stages for the products that got content
+def drive_watcher_gpt_batch(max_workers=WORKER_COUNT):
+    print("Starting drive watcher in GPT batch mode")
+    service = get_shared_drive_service()
+    if service is None:
+        print("Failed to initialize Google Drive service")
+        return []
+
+    print("Checking for images in Unprocessed folder")
+    image_files = list_image_files(service, UNPROCESSED_FOLDER_ID)
+    if not image_files:
+        print("No images found")
+        return []
+
+    # Claim the folders before paying for their GPT requests. process_image_files claims them again, which a holder may do
+    image_files = [image_file for image_file in claim_order(image_files) if claim_product(image_file)]
+    if not image_files:
+        print("Every product folder is leased by another instance")
+        return []
+
+    from product_pipeline import generate_listings_with_batch
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        ready = generate_listings_with_batch(image_files, executor)
+    print("Product folders with listing content:", len(ready), "of", len(image_files))
+    ready_ids = set(image_file['product_folder_id'] for image_file in ready)
+    for image_file in image_files:
+        if image_file['product_folder_id'] not in ready_ids:
+            release_product(image_file)
+    if not ready:
+        return []
+    return process_image_files(ready, max_workers)
+
+# Full scan of the Unprocessed folder. Returns the changes cursor taken before the scan started
+def full_rescan(service, max_workers):
+    # Take the cursor first so anything added while we scan still shows up in the next poll
+    page_token = get_start_page_token(service)
+    print("Running full rescan of Unprocessed folder")
+    image_files = list_image_files(service, UNPROCESSED_FOLDER_ID)
+    if image_files:
+        process_image_files(image_files, max_workers)
+    else:
+        print("No images found")
+    return page_token
+
+# Daemon watcher: keep running and only look at product folders the Drive changes feed reports as new or modified
+def drive_watcher_daemon(max_workers=WORKER_COUNT):
+    print("Starting drive watcher in daemon mode")
+    service = get_shared_drive_service()
+    if service is None:
+        print("Failed to initialize Google Drive service")
+        return
+
+    page_token = load_page_token()
+    last_full_rescan = 0
+    interval = DAEMON_MIN_INTERVAL
+    last_poll = time.time()
+    while True:
+        try:
+            rescan_due = DAEMON_FULL_RESCAN_SECONDS > 0 and time.time() - last_full_rescan >= DAEMON_FULL_RESCAN_SECONDS
+            if page_token is None or rescan_due:
+                page_token = full_rescan(service, max_workers)
+                last_full_rescan = time.time()
+                save_page_token(page_token)
+
+            # Our own lease claims and releases since the last poll show up as folder changes. Skip them, or a folder
+            # that failed would be retried on every poll instead of on the next full rescan
+            lease_written = lease_writes_since(last_poll)
+            last_poll = time.time()
+            changes, new_page_token = list_changes(service, page_token)
+            product_folders = find_changed_product_folders(service, changes, UNPROCESSED_FOLDER_ID, lease_written)
+            if product_folders:
+                print("Changed product folders:", len(product_folders))
+                image_files = list_images_in_folders(service, product_folders)
+                if image_files:
+                    process_image_files(image_files, max_workers)
+                # Something is happening, so check again soon
+                interval = DAEMON_MIN_INTERVAL
+            else:
+                # Nothing new, so wait longer before the next poll
+                interval = min(interval * 2, DAEMON_MAX_INTERVAL)
+
+            # Only move the cursor forward after the changes were handled, so a crash replays them
+            if new_page_token is not None:
+                page_token = new_page_token
+                save_page_token(page_token)
+        except Exception as e:
+            print("Error in drive_watcher_daemon:", e)
+            interval = DAEMON_MAX_INTERVAL
+
+        print("Next poll in seconds:", interval)
+        time.sleep(interval)
+
 if __name__ == "__main__":
-    drive_watcher()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create Etsy draft listings from the Unprocessed Drive folder")
+    parser.add_argument("--batch", action="store_true", help="process every product folder instead of just one")
+    parser.add_argument("--daemon", action="store_true", help="keep running and follow the Drive changes feed")
+    parser.add_argument("--gpt-batch", action="store_true", help="generate all listing content with one OpenAI Batch API job, then publish")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT, help="how many product folders to process at once in batch mode")
+    args = parser.parse_args()
+
+    if args.gpt_batch:
+        drive_watcher_gpt_batch(max_workers=max(1, args.workers))
+    elif args.daemon:
+        drive_watcher_daemon(max_workers=max(1, args.workers))
+    elif args.batch:
+        drive_watcher_batch(max_workers=max(1, args.workers))
+    else:
+        drive_watcher()
@@ -0,0 +1,153 @@
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import current_span
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv('config.env')
+
+# Etsy allows a handful of requests per second and a daily total per app
+ETSY_REQUESTS_PER_SECOND = float(os.getenv('ETSY_REQUESTS_PER_SECOND', '5'))
+ETSY_REQUESTS_PER_DAY = int(os.getenv('ETSY_REQUESTS_PER_DAY', '10000'))
+ETSY_MAX_RETRIES = int(os.getenv('ETSY_MAX_RETRIES', '4'))
+ETSY_POOL_SIZE = int(os.getenv('ETSY_POOL_SIZE', '10'))
+ETSY_TIMEOUT_SECONDS = float(os.getenv('ETSY_TIMEOUT_SECONDS', '60'))
+
+# Raised when the daily Etsy request budget is used up
+class EtsyDailyLimitError(Exception):
+    pass
+
+# Token bucket shared by every thread. Each request takes one token and tokens refill at a fixed rate per second
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Block until a token is free, then take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    # Stop handing out tokens for the given number of seconds, e.g. after Etsy sends Retry-After
+    def pause(self, seconds):
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+# Etsy API client with a keep-alive connection pool, a shared rate limiter and retries with backoff
+class EtsyClient:
+    def __init__(self, api_key, requests_per_second=ETSY_REQUESTS_PER_SECOND, requests_per_day=ETSY_REQUESTS_PER_DAY,
+                 max_retries=ETSY_MAX_RETRIES, pool_size=ETSY_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['x-api-key'] = api_key
+        self.rate_limiter = TokenBucket(requests_per_second, max(1, requests_per_second))
+        self.requests_per_day = requests_per_day
+        self.max_retries = max_retries
+        self.day_lock = threading.Lock()
+        self.day = time.strftime('%Y-%m-%d')
+        self.requests_today = 0
+
+    # Count a request against today's budget
+    def use_daily_budget(self):
+        with self.day_lock:
+            today = time.strftime('%Y-%m-%d')
+            if today != self.day:
+                self.day = today
+                self.requests_today = 0
+            if self.requests_today >= self.requests_per_day:
+                raise EtsyDailyLimitError("Daily Etsy request limit reached")
+            self.requests_today = self.requests_today + 1
+
+    # Etsy tells us how many requests are left today. Trust it over our own count
+    def read_remaining_today(self, response):
+        remaining = response.headers.get('x-remaining-today')
+        if remaining is not None and remaining.isdigit():
+            with self.day_lock:
+                self.requests_today = max(self.requests_today, self.requests_per_day - int(remaining))
+
+    # Seconds to wait before the next attempt. Uses Retry-After when Etsy sends it, otherwise exponential backoff with jitter
+    def retry_delay(self, response, attempt):
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None:
+                try:
+                    return max(0.0, float(retry_after))
+                except ValueError:
+                    pass
+        return min(30.0, (2 ** attempt) * 0.5) * random.uniform(0.5, 1.5)
+
+    # Upload bodies are file objects, so rewind them before sending again
+    def rewind_files(self, files):
+        if not files:
+            return
+        for value in files.values():
+            file_object = value[1] if isinstance(value, tuple) else value
+            if hasattr(file_object, 'seek'):
+                file_object.seek(0)
+
+    # Send a request. 429 responses are always retried because Etsy did not process them.
+    # Network errors and 5xx responses are only retried when idempotent is True, so a listing is never created twice
+    def request(self, method, url, idempotent=False, **kwargs):
+        kwargs.setdefault('timeout', ETSY_TIMEOUT_SECONDS)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            self.use_daily_budget()
+            self.rewind_files(kwargs.get('files'))
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(None, attempt)
+                print("Etsy request failed, retrying in", round(delay, 1), "seconds:", e)
+                current_span().add_retries(1)
+                time.sleep(delay)
+                attempt = attempt + 1
+                continue
+
+            self.read_remaining_today(response)
+            should_retry = response.status_code == 429 or (idempotent and response.status_code >= 500)
+            if not should_retry or attempt >= self.max_retries:
+                return response
+
+            delay = self.retry_delay(response, attempt)
+            print("Etsy returned", response.status_code, "- retrying in", round(delay, 1), "seconds")
+            current_span().add_retries(1)
+            if response.status_code == 429:
+                # Slow down every thread, not just this one
+                self.rate_limiter.pause(delay)
+            time.sleep(delay)
+            attempt = attempt + 1
+
+    def post(self, url, idempotent=False, **kwargs):
+        return self.request('POST', url, idempotent=idempotent, **kwargs)
+
+# One client is shared by all threads so they share the connection pool and the rate limit
+_client = None
+_client_lock = threading.Lock()
+
+# Get the shared Etsy client
+def get_etsy_client(api_key):
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = EtsyClient(api_key)
+        return _client
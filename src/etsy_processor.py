@@ -1,5 +1,8 @@
 import os
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from image_buffer import ImageBuffer
+from etsy_client import get_etsy_client
+from metrics import timed_stage
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -9,8 +12,21 @@ load_dotenv()
 ETSY_API_KEY = os.getenv('ETSY_API_KEY')
 ETSY_SHOP_ID = os.getenv('ETSY_SHOP_ID')
 
-# Etsy API base URL (Makes it easier to build API URLs)
-ETSY_API_BASE = "https://openapi.etsy.com/v3/application"
+# How many images of one product are uploaded to Etsy at the same time
+ETSY_UPLOAD_WORKERS = int(os.getenv('ETSY_UPLOAD_WORKERS', '4'))
+
+# Size of an image for the upload metrics
+def image_size(image_path):
+    if isinstance(image_path, ImageBuffer):
+        return image_path.size
+    return os.path.getsize(image_path)
+
+# Etsy API base URL (Makes it easier to build API URLs). Point it at fake_etsy_server to run without a real shop
+ETSY_API_BASE = os.getenv('ETSY_API_BASE', "https://openapi.etsy.com/v3/application").rstrip('/')
+
+# True if the Etsy API key and shop ID are set
+def etsy_configured():
+    return ETSY_API_KEY is not None and ETSY_SHOP_ID is not None
 
 # Create a draft listing on Etsy using the generated content and product information.
 def create_etsy_draft_listing(listing_data, image_path, product_info):
@@ -36,47 +52,51 @@ def create_etsy_draft_listing(listing_data, image_path, product_info):
         print("Error in create_etsy_draft_listing:", e)
         return None
 
-# Upload an image to Etsy and return the image ID.
+# Upload an image to Etsy and return the image ID. image_path can also be an ImageBuffer that is already in memory
+@timed_stage('etsy_upload', count_bytes=lambda args, result: image_size(args[0]))
 def upload_image_to_etsy(image_path):
     try:
         print("Uploading image to Etsy")
         upload_url = f"{ETSY_API_BASE}/shops/{ETSY_SHOP_ID}/listings/images"
         
-        headers = {
-            'x-api-key': ETSY_API_KEY,
-            'Content-Type': 'multipart/form-data'
-        }
+        # The API key header comes from the client. Content-Type is left to requests so it can add the multipart boundary
+        client = get_etsy_client(ETSY_API_KEY)
         
-        with open(image_path, 'rb') as image_file:
-            files = {'image': image_file}
-            response = requests.post(upload_url, headers=headers, files=files)
-            print("Upload response status:", response.status_code)
-            if response.status_code == 201:
-                image_data = response.json()
-                image_id = image_data.get('image_id')
-                if image_id is not None:
-                    print("Image uploaded")
-                    return image_id
-                else:
-                    print("No image ID in response")
-                    return None
+        # Retrying an upload is safe. At worst Etsy keeps an unused image
+        if isinstance(image_path, ImageBuffer):
+            files = {'image': (image_path.file_name, image_path.open_for_upload())}
+            response = client.post(upload_url, idempotent=True, files=files)
+        else:
+            with open(image_path, 'rb') as image_file:
+                files = {'image': image_file}
+                response = client.post(upload_url, idempotent=True, files=files)
+
+        print("Upload response status:", response.status_code)
+        if response.status_code == 201:
+            image_data = response.json()
+            image_id = image_data.get('image_id')
+            if image_id is not None:
+                print("Image uploaded")
+                return image_id
             else:
-                print("Upload failed")
+                print("No image ID in response")
                 return None
+        else:
+            print("Upload failed")
+            return None
     except Exception as e:
         print("Error in upload_image_to_etsy:", e)
         return None
 
-# Create a draft listing on Etsy with the content and image
-def create_draft_listing(listing_data, image_id, product_info):
+# Create a draft listing on Etsy with the content and image.
+# Pass associate_image=False to attach the image separately with add_image_to_listing
+@timed_stage('etsy_create_listing')
+def create_draft_listing(listing_data, image_id, product_info, associate_image=True):
     try:
         print("Creating draft listing")
         listing_url = f"{ETSY_API_BASE}/shops/{ETSY_SHOP_ID}/listings"
         
-        headers = {
-            'x-api-key': ETSY_API_KEY,
-            'Content-Type': 'application/json'
-        }
+        client = get_etsy_client(ETSY_API_KEY)
         
         price_cents = int(float(product_info['price']) * 100)
         
@@ -95,14 +115,16 @@ def create_draft_listing(listing_data, image_id, product_info):
             'tags': listing_data['tags']
         }
         
-        response = requests.post(listing_url, headers=headers, json=listing_payload)
+        # Not idempotent: a retried create after a server error could make a second draft
+        response = client.post(listing_url, json=listing_payload)
         print("Listing creation response status:", response.status_code)
         if response.status_code == 201:
             listing_response = response.json()
             listing_id = listing_response.get('listing_id')
             print("Draft listing created")
-            add_image_to_listing(listing_id, image_id)
-            print("Associated uploaded image with the listing")
+            if associate_image:
+                add_image_to_listing(listing_id, image_id)
+                print("Associated uploaded image with the listing")
             return listing_id
         else:
             print("Draft listing creation failed")
@@ -111,17 +133,38 @@ def create_draft_listing(listing_data, image_id, product_info):
         print("Error in create_draft_listing:", e)
         return None
 
-# Add an uploaded image to a listing.
-def add_image_to_listing(listing_id, image_id):
+# Upload several images at the same time, at most max_workers at once.
+# Returns the image IDs in the same order as image_paths, with None for uploads that failed
+def upload_images_to_etsy(image_paths, max_workers=ETSY_UPLOAD_WORKERS):
+    if len(image_paths) == 1:
+        return [upload_image_to_etsy(image_paths[0])]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_paths)))) as executor:
+        return list(executor.map(upload_image_to_etsy, image_paths))
+
+# Add an uploaded image to a listing. rank is its position in the listing, starting at 1. Returns True if Etsy accepted it
+@timed_stage('etsy_associate_image')
+def add_image_to_listing(listing_id, image_id, rank=None):
     try:
         print("Associating image with listing")
         image_url = f"{ETSY_API_BASE}/listings/{listing_id}/images/{image_id}"
         
-        headers = {
-            'x-api-key': ETSY_API_KEY
-        }
+        client = get_etsy_client(ETSY_API_KEY)
         
-        response = requests.post(image_url, headers=headers)
+        # Associating the same image again does no harm, so this can be retried
+        data = {'rank': rank} if rank is not None else None
+        response = client.post(image_url, idempotent=True, data=data)
         print("Image association response status:", response.status_code)
+        return 200 <= response.status_code < 300
     except Exception as e:
-        print("Error in add_image_to_listing:", e)
\ No newline at end of file
+        print("Error in add_image_to_listing:", e)
+        return False
+
+# Add several uploaded images to a listing. image_ids are in rank order and each call carries its rank,
+# so they can be sent at the same time. Returns True if every image was accepted
+def add_images_to_listing(listing_id, image_ids, max_workers=ETSY_UPLOAD_WORKERS):
+    if len(image_ids) == 1:
+        return add_image_to_listing(listing_id, image_ids[0], rank=1)
+    ranks = list(range(1, len(image_ids) + 1))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_ids)))) as executor:
+        results = list(executor.map(lambda image_id, rank: add_image_to_listing(listing_id, image_id, rank), image_ids, ranks))
+    return all(results)
@@ -0,0 +1,97 @@
+import re
+import json
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local HTTP front for FakeDriveService that answers the Drive v3 REST calls the pipeline makes: files.list,
+# files.get (metadata and alt=media with Range), and files.update moves. Unlike handing the pipeline a
+# FakeDriveService directly, requests go through a real googleapiclient service and its HTTP connections,
+# which is what the Drive connection pool benchmark needs to measure
+
+class FakeDriveHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so a pooled connection is reused for many requests
+    protocol_version = 'HTTP/1.1'
+
+    # Set by start_fake_drive_server
+    drive = None
+    connections = 0
+    lock = threading.Lock()
+
+    # Called once for every new TCP connection
+    def setup(self):
+        super().setup()
+        with self.lock:
+            FakeDriveHandler.connections = FakeDriveHandler.connections + 1
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data).encode('utf-8'))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        match = re.search(r'/files/([^/]+)$', url.path)
+        if match is None:
+            self.drive.simulate_call()
+            self.send_json(200, {'files': self.drive.find_files(query.get('q', ''))})
+            return
+
+        file_id = match.group(1)
+        if query.get('alt') != 'media':
+            self.drive.simulate_call()
+            with self.drive.lock:
+                file = self.drive.files_by_id.get(file_id)
+                file = dict(file) if file is not None else None
+            if file is None:
+                self.send_json(404, {'error': {'code': 404, 'message': 'File not found'}})
+            else:
+                self.send_json(200, file)
+            return
+
+        content = self.drive.contents.get(file_id)
+        if content is None:
+            self.send_json(404, {'error': {'code': 404, 'message': 'File not found'}})
+            return
+        start, end = 0, len(content) - 1
+        range_match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('range', ''))
+        if range_match:
+            start, end = int(range_match.group(1)), min(int(range_match.group(2)), len(content) - 1)
+        chunk = content[start:end + 1]
+        self.drive.simulate_call(len(chunk))
+        self.send_body(206, chunk, 'application/octet-stream', {'Content-Range': f"bytes {start}-{end}/{len(content)}"})
+
+    def do_PATCH(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        if length:
+            self.rfile.read(length)
+        url = urlsplit(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        file_id = re.search(r'/files/([^/]+)$', url.path).group(1)
+        self.drive.simulate_call()
+        self.send_json(200, self.drive.move_file(file_id, query.get('addParents'), query.get('removeParents')))
+
+    # Keep the benchmark output readable
+    def log_message(self, format, *args):
+        pass
+
+# Serve the given FakeDriveService on a free local port in a background thread.
+# Returns the server and the endpoint to pass to build_drive_service as api_endpoint
+def start_fake_drive_server(drive, port=0):
+    FakeDriveHandler.drive = drive
+    FakeDriveHandler.connections = 0
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeDriveHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    api_endpoint = f"http://127.0.0.1:{server.server_address[1]}/drive/v3/"
+    print("Fake Drive server running at:", api_endpoint)
+    return server, api_endpoint
@@ -0,0 +1,199 @@
+import re
+import time
+import hashlib
+import threading
+import httplib2
+
+# An in-memory stand-in for the Google Drive v3 service, so the pipeline can run without credentials or network.
+# It answers only the calls the pipeline makes: files().list, get, update (moves and appProperties), get_media, batch requests and thumbnail links
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Fake Drive that holds an Unprocessed folder full of product folders with images in them.
+# latency_seconds is added to every API call and bytes_per_second limits media downloads (0 means no limit)
+class FakeDriveService:
+    def __init__(self, latency_seconds=0.0, bytes_per_second=0):
+        self.latency_seconds = latency_seconds
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.files_by_id = {}
+        self.contents = {}
+        self.api_calls = 0
+        self._http = FakeDriveHttp(self)
+
+    # Replace everything in the fake Drive with folder_count product folders in unprocessed_folder_id,
+    # each with images_per_folder copies of image_data
+    def load_backlog(self, unprocessed_folder_id, folder_count, images_per_folder, image_data, image_width, image_height):
+        with self.lock:
+            self.files_by_id = {}
+            self.contents = {}
+            self.api_calls = 0
+            for folder_number in range(folder_count):
+                folder_id = f"folder-{folder_number}"
+                self.files_by_id[folder_id] = {
+                    'id': folder_id,
+                    'name': f"Painting {folder_number}_Original_16x20_{100 + folder_number}",
+                    'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [unprocessed_folder_id]
+                }
+                for image_number in range(images_per_folder):
+                    file_id = f"image-{folder_number}-{image_number}"
+                    # Bytes after the end of a JPEG are ignored by readers, so this keeps every image's hash different
+                    content = image_data + file_id.encode('utf-8')
+                    self.contents[file_id] = content
+                    self.files_by_id[file_id] = {
+                        'id': file_id,
+                        'name': f"{image_number + 1}_view.jpg",
+                        'mimeType': 'image/jpeg',
+                        'parents': [folder_id],
+                        'md5Checksum': hashlib.md5(content).hexdigest(),
+                        'size': str(len(content)),
+                        'thumbnailLink': f"fake://drive/thumbnails/{file_id}=s220",
+                        'imageMediaMetadata': {'width': image_width, 'height': image_height, 'rotation': 0}
+                    }
+
+    # Count the call and wait like a real round trip would
+    def simulate_call(self, byte_count=0):
+        with self.lock:
+            self.api_calls = self.api_calls + 1
+        delay = self.latency_seconds
+        if self.bytes_per_second > 0:
+            delay = delay + byte_count / self.bytes_per_second
+        if delay > 0:
+            time.sleep(delay)
+
+    def files(self):
+        return FakeFilesResource(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+    # Files matching the parts of a query the pipeline uses: "'<id>' in parents" clauses and the mime type
+    def find_files(self, query):
+        parent_ids = set(re.findall(r"'([^']+)' in parents", query))
+        want_folders = f"mimeType='{FOLDER_MIME_TYPE}'" in query
+        want_images = "mimeType contains 'image/'" in query
+        with self.lock:
+            matches = []
+            for file in self.files_by_id.values():
+                if parent_ids and not parent_ids.intersection(file['parents']):
+                    continue
+                if want_folders and file['mimeType'] != FOLDER_MIME_TYPE:
+                    continue
+                if want_images and not file['mimeType'].startswith('image/'):
+                    continue
+                matches.append(dict(file))
+            return matches
+
+    # Like Drive, a property set to None is deleted
+    def update_app_properties(self, file_id, app_properties):
+        with self.lock:
+            file = self.files_by_id[file_id]
+            merged = dict(file.get('appProperties') or {})
+            for key, value in app_properties.items():
+                if value is None:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = value
+            file['appProperties'] = merged
+            return {'id': file_id}
+
+    def move_file(self, file_id, add_parents, remove_parents):
+        with self.lock:
+            file = self.files_by_id[file_id]
+            parents = [parent for parent in file['parents'] if parent != remove_parents]
+            parents.append(add_parents)
+            file['parents'] = parents
+            return {'id': file_id, 'parents': list(parents)}
+
+# Mimics googleapiclient's request objects: nothing happens until execute() is called
+class FakeRequest:
+    def __init__(self, service, action):
+        self.service = service
+        self.action = action
+
+    def execute(self):
+        self.service.simulate_call()
+        return self.action()
+
+# Mimics BatchHttpRequest: every added request is answered in one round trip and reported through the callback
+class FakeBatchRequest:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id or str(len(self.requests) + 1), request, callback or self.callback))
+
+    def execute(self):
+        self.service.simulate_call()
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request.action(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+
+class FakeFilesResource:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, q='', fields=None, pageSize=100, pageToken=None, **kwargs):
+        def action():
+            matches = self.service.find_files(q)
+            start = int(pageToken) if pageToken else 0
+            page = {'files': matches[start:start + pageSize]}
+            if start + pageSize < len(matches):
+                page['nextPageToken'] = str(start + pageSize)
+            return page
+        return FakeRequest(self.service, action)
+
+    def get(self, fileId, fields=None, **kwargs):
+        def action():
+            with self.service.lock:
+                return dict(self.service.files_by_id[fileId])
+        return FakeRequest(self.service, action)
+
+    def update(self, fileId, addParents=None, removeParents=None, body=None, fields=None, **kwargs):
+        if body is not None and 'appProperties' in body:
+            return FakeRequest(self.service, lambda: self.service.update_app_properties(fileId, body['appProperties']))
+        return FakeRequest(self.service, lambda: self.service.move_file(fileId, addParents, removeParents))
+
+    # The returned object has what MediaIoBaseDownload reads from a real media request
+    def get_media(self, fileId, **kwargs):
+        return FakeMediaRequest(self.service, fileId)
+
+class FakeMediaRequest:
+    def __init__(self, service, file_id):
+        self.http = service._http
+        self.uri = f"fake://drive/files/{file_id}"
+        self.headers = {}
+
+# Answers the raw HTTP requests made for media downloads (with a Range header) and thumbnails
+class FakeDriveHttp:
+    def __init__(self, service):
+        self.service = service
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        file_id = re.sub(r'=s\d+$', '', uri.rsplit('/', 1)[1])
+        content = self.service.contents.get(file_id)
+        if content is None:
+            return httplib2.Response({'status': 404}), b''
+
+        if '/thumbnails/' in uri:
+            # A real thumbnail is smaller, but the original bytes are enough to exercise the code path
+            self.service.simulate_call(len(content))
+            return httplib2.Response({'status': 200, 'content-length': str(len(content))}), content
+
+        range_header = (headers or {}).get('range')
+        start, end = 0, len(content) - 1
+        if range_header is not None:
+            match = re.match(r'bytes=(\d+)-(\d+)', range_header)
+            if match:
+                start, end = int(match.group(1)), min(int(match.group(2)), len(content) - 1)
+        chunk = content[start:end + 1]
+        self.service.simulate_call(len(chunk))
+        response = httplib2.Response({'status': 206, 'content-range': f"bytes {start}-{end}/{len(content)}"})
+        return response, chunk
@@ -0,0 +1,76 @@
+import re
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for the Etsy v3 endpoints the pipeline calls: image upload, draft listing creation and
+# adding an image to a listing. Set ETSY_API_BASE to its base URL to run the pipeline without touching a real shop
+
+# How long every request takes, in seconds. Set by start_fake_etsy_server
+RESPONSE_DELAY_SECONDS = 0.0
+
+class FakeEtsyHandler(BaseHTTPRequestHandler):
+    # Shared state of the fake server
+    counts = {'images': 0, 'listings': 0, 'associations': 0}
+    lock = threading.Lock()
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-remaining-today', '100000')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        body = self.read_body()
+        if RESPONSE_DELAY_SECONDS > 0:
+            time.sleep(RESPONSE_DELAY_SECONDS)
+        path = self.path.split('?', 1)[0]
+        if re.search(r'/shops/[^/]+/listings/images$', path):
+            with self.lock:
+                self.counts['images'] = self.counts['images'] + 1
+                image_id = self.counts['images']
+            self.send_json(201, {'image_id': image_id, 'bytes_received': len(body)})
+        elif re.search(r'/shops/[^/]+/listings$', path):
+            listing = json.loads(body)
+            with self.lock:
+                self.counts['listings'] = self.counts['listings'] + 1
+                listing_id = self.counts['listings']
+            self.send_json(201, {'listing_id': listing_id, 'title': listing.get('title'), 'state': 'draft'})
+        elif re.search(r'/listings/\d+/images/\d+$', path):
+            with self.lock:
+                self.counts['associations'] = self.counts['associations'] + 1
+            self.send_json(201, {'listing_image_id': self.counts['associations']})
+        else:
+            self.send_json(404, {'error': 'Unknown path'})
+
+    # Keep the benchmark output readable
+    def log_message(self, format, *args):
+        pass
+
+# Start the fake server on a free local port in a background thread. Returns the server and the base URL to use as ETSY_API_BASE
+def start_fake_etsy_server(port=0, delay_seconds=0.0):
+    global RESPONSE_DELAY_SECONDS
+    RESPONSE_DELAY_SECONDS = delay_seconds
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeEtsyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v3/application"
+    print("Fake Etsy server running at:", base_url)
+    return server, base_url
+
+if __name__ == "__main__":
+    server, base_url = start_fake_etsy_server(8090)
+    print("Set ETSY_API_BASE to", base_url, "and press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,221 @@
+import json
+import time
+import email
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# A local stand-in for the OpenAI chat completions, Files and Batch endpoints, so GPT calls and batch mode can be tried
+# without an API key or network. Every chat request, direct or in a batch, gets back a valid listing from fake_listing_response
+
+# How many status checks a batch stays "in_progress" before it completes
+POLLS_BEFORE_COMPLETE = 1
+
+# How long a direct chat completion takes, in seconds. Set by start_fake_openai_server
+CHAT_DELAY_SECONDS = 0.0
+
+# Share of direct chat completions that come back with the wrong number of tags, to exercise validation and retries
+BAD_RESPONSE_RATE = 0.0
+
+# Chat completions allowed per minute before the fake server answers 429 like OpenAI does. 0 means no limit.
+# Like OpenAI, the allowance refills continuously instead of resetting once a minute
+REQUESTS_PER_MINUTE = 0
+_rate_state = {'available': None, 'last_refill': None}
+_rate_lock = threading.Lock()
+
+# Count a chat completion against the fake limit. Returns the seconds until one is free if it is over the limit, else 0
+def check_rate_limit():
+    if REQUESTS_PER_MINUTE <= 0:
+        return 0
+    with _rate_lock:
+        now = time.monotonic()
+        if _rate_state['available'] is None:
+            _rate_state['available'] = float(REQUESTS_PER_MINUTE)
+            _rate_state['last_refill'] = now
+        refill = (now - _rate_state['last_refill']) * REQUESTS_PER_MINUTE / 60
+        _rate_state['available'] = min(REQUESTS_PER_MINUTE, _rate_state['available'] + refill)
+        _rate_state['last_refill'] = now
+        if _rate_state['available'] < 1:
+            return (1 - _rate_state['available']) * 60 / REQUESTS_PER_MINUTE
+        _rate_state['available'] = _rate_state['available'] - 1
+        return 0
+
+# Streamed completions are sent in pieces of this many characters
+STREAM_PIECE_CHARACTERS = 16
+
+# The listing content the fake server returns. bad listings have 12 tags instead of 13
+def fake_listing(bad=False):
+    return {
+        'title': 'Original Landscape Painting Wall Art',
+        'description': 'A fake description returned by the local test server.',
+        'tags': [f"tag{number}" for number in range(1, 13 if bad else 14)]
+    }
+
+# The chat completion the fake server returns for every request
+def fake_listing_response(request_body, bad=False):
+    listing = fake_listing(bad)
+    return {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion',
+        'model': request_body.get('model'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': json.dumps(listing)}, 'finish_reason': 'stop'}]
+    }
+
+# Get the uploaded file out of a multipart/form-data body
+def read_multipart_file(content_type, body):
+    message = email.message_from_bytes(b'Content-Type: ' + content_type.encode('utf-8') + b'\r\n\r\n' + body)
+    for part in message.walk():
+        if part.get_filename() is not None:
+            return part.get_payload(decode=True)
+    return b''
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # Shared state of the fake server
+    files = {}
+    batches = {}
+    lock = threading.Lock()
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', '0'))
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/v1/chat/completions':
+            # Answered outside the lock so slow completions overlap like real ones
+            request = json.loads(body)
+            reset_seconds = check_rate_limit()
+            if reset_seconds > 0:
+                self.send_rate_limited(reset_seconds)
+                return
+            bad = random.random() < BAD_RESPONSE_RATE
+            if request.get('stream'):
+                self.send_stream(request, bad)
+                return
+            if CHAT_DELAY_SECONDS > 0:
+                time.sleep(CHAT_DELAY_SECONDS)
+            self.send_json(200, fake_listing_response(request, bad))
+            return
+        with self.lock:
+            if self.path == '/v1/files':
+                file_id = f"file-{len(self.files) + 1}"
+                self.files[file_id] = read_multipart_file(self.headers.get('Content-Type', ''), body)
+                self.send_json(200, {'id': file_id, 'object': 'file', 'purpose': 'batch'})
+            elif self.path == '/v1/batches':
+                request = json.loads(body)
+                batch_id = f"batch-{len(self.batches) + 1}"
+                self.batches[batch_id] = {'id': batch_id, 'status': 'in_progress', 'polls': 0,
+                                          'input_file_id': request['input_file_id'], 'output_file_id': None,
+                                          'created_at': int(time.time())}
+                self.send_json(200, self.public_batch(self.batches[batch_id]))
+            else:
+                self.send_json(404, {'error': {'message': 'Unknown path'}})
+
+    def do_GET(self):
+        with self.lock:
+            parts = self.path.strip('/').split('/')
+            if len(parts) == 3 and parts[:2] == ['v1', 'batches'] and parts[2] in self.batches:
+                batch = self.batches[parts[2]]
+                batch['polls'] = batch['polls'] + 1
+                if batch['status'] == 'in_progress' and batch['polls'] > POLLS_BEFORE_COMPLETE:
+                    self.complete_batch(batch)
+                self.send_json(200, self.public_batch(batch))
+            elif len(parts) == 4 and parts[:2] == ['v1', 'files'] and parts[3] == 'content' and parts[2] in self.files:
+                content = self.files[parts[2]]
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/jsonl')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self.send_json(404, {'error': {'message': 'Unknown path'}})
+
+    def send_rate_limited(self, reset_seconds):
+        body = json.dumps({'error': {'message': 'Rate limit reached for requests', 'type': 'requests', 'code': 'rate_limit_exceeded'}}).encode('utf-8')
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-ratelimit-limit-requests', str(REQUESTS_PER_MINUTE))
+        self.send_header('x-ratelimit-remaining-requests', '0')
+        self.send_header('x-ratelimit-reset-requests', f"{reset_seconds:.3f}s")
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Send the completion as server-sent events, a few characters at a time, spread over CHAT_DELAY_SECONDS
+    def send_stream(self, request, bad):
+        content = json.dumps(fake_listing(bad), indent=2)
+        pieces = [content[start:start + STREAM_PIECE_CHARACTERS] for start in range(0, len(content), STREAM_PIECE_CHARACTERS)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        try:
+            for piece in pieces:
+                if CHAT_DELAY_SECONDS > 0:
+                    time.sleep(CHAT_DELAY_SECONDS / len(pieces))
+                chunk = {
+                    'id': 'chatcmpl-fake',
+                    'object': 'chat.completion.chunk',
+                    'model': request.get('model'),
+                    'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]
+                }
+                self.wfile.write(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early, like the pipeline does when a field breaks the limits
+            pass
+
+    # Answer every line of the input file and store the answers as the output file
+    def complete_batch(self, batch):
+        output_lines = []
+        for text_line in self.files[batch['input_file_id']].decode('utf-8').splitlines():
+            if not text_line.strip():
+                continue
+            request = json.loads(text_line)
+            output_lines.append(json.dumps({
+                'id': f"response-{request['custom_id']}",
+                'custom_id': request['custom_id'],
+                'response': {'status_code': 200, 'body': fake_listing_response(request['body'])},
+                'error': None
+            }))
+        output_file_id = f"file-{len(self.files) + 1}"
+        self.files[output_file_id] = ("\n".join(output_lines) + "\n").encode('utf-8')
+        batch['output_file_id'] = output_file_id
+        batch['status'] = 'completed'
+
+    def public_batch(self, batch):
+        return {key: value for key, value in batch.items() if key != 'polls'}
+
+    # Keep the test output readable
+    def log_message(self, format, *args):
+        pass
+
+# Start the fake server on a free local port in a background thread. Returns the server and its /v1 base URL
+def start_fake_openai_server(port=0, chat_delay_seconds=0.0, bad_response_rate=0.0, requests_per_minute=0):
+    global CHAT_DELAY_SECONDS, BAD_RESPONSE_RATE, REQUESTS_PER_MINUTE
+    CHAT_DELAY_SECONDS = chat_delay_seconds
+    BAD_RESPONSE_RATE = bad_response_rate
+    REQUESTS_PER_MINUTE = requests_per_minute
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeOpenAIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    print("Fake OpenAI server running at:", base_url)
+    return server, base_url
+
+if __name__ == "__main__":
+    server, base_url = start_fake_openai_server(8089)
+    print("Set OPENAI_API_BASE to", base_url, "and press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
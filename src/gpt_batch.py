@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import threading
+import requests
+from gpt_processor import build_listing_prompt, build_chat_request, parse_listing_response
+from image_preprocessor import prepare_gpt_image
+import job_journal
+from job_journal import record_batch, record_batch_finished, record_batch_poll_failed, get_unfinished_batches
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv('config.env')
+
+# OpenAI REST base URL. Point it at fake_openai_server to try batch mode offline
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
+
+# How often to check whether a batch has finished
+GPT_BATCH_POLL_SECONDS = float(os.getenv('GPT_BATCH_POLL_SECONDS', '30'))
+
+# The Batch API takes input files up to 200 MB, so bigger batches are split into several files
+GPT_BATCH_MAX_BYTES = int(os.getenv('GPT_BATCH_MAX_BYTES', str(190 * 1024 * 1024)))
+GPT_BATCH_DIR = os.getenv('GPT_BATCH_DIR', 'gpt_batches')
+
+# Seconds to wait for OpenAI to connect or send data on each REST call, so a stuck connection can not hang the run
+GPT_BATCH_REQUEST_TIMEOUT = float(os.getenv('GPT_BATCH_REQUEST_TIMEOUT', '120'))
+
+# A status check that fails with a network error, 429 or 5xx is tried again on the next poll. After this many failures
+# in a row the run stops waiting for that batch, and it stays in the journal for the next run to pick up
+GPT_BATCH_POLL_RETRIES = int(os.getenv('GPT_BATCH_POLL_RETRIES', '20'))
+
+# A batch that several runs in a row could not check is abandoned, so its products go into a new batch
+GPT_BATCH_MAX_FAILED_RUNS = int(os.getenv('GPT_BATCH_MAX_FAILED_RUNS', '3'))
+
+# Batch states after which the batch will not change any more
+FINISHED_BATCH_STATES = ('completed', 'failed', 'expired', 'cancelled')
+
+# Auth header for the OpenAI REST API
+def openai_headers():
+    return {'Authorization': f"Bearer {os.getenv('OPENAI_API_KEY', '')}"}
+
+# Build one JSONL line of the batch input: the same chat request generate_etsy_listing_content sends
+def make_batch_line(custom_id, image_path, product_info):
+    base64_image, image_mime_type = prepare_gpt_image(image_path)
+    if base64_image is None:
+        return None
+    prompt = build_listing_prompt(product_info)
+    line = {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': build_chat_request(prompt, base64_image, image_mime_type)
+    }
+    return json.dumps(line)
+
+# Writes batch lines to JSONL files, starting a new file when one would go over GPT_BATCH_MAX_BYTES.
+# Several threads can add lines at the same time
+class BatchFileWriter:
+    def __init__(self, directory=GPT_BATCH_DIR, max_bytes=GPT_BATCH_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.paths = []
+        # Product folder IDs in each file, keyed by path
+        self.custom_ids = {}
+        self.current_file = None
+        self.current_size = 0
+        self.line_count = 0
+
+    # Start the next JSONL file
+    def open_next_file(self):
+        if self.current_file is not None:
+            self.current_file.close()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"batch_{int(time.time())}_{len(self.paths)}.jsonl")
+        self.current_file = open(path, 'w', encoding='utf-8')
+        self.current_size = 0
+        self.paths.append(path)
+        self.custom_ids[path] = []
+
+    def add(self, custom_id, line):
+        data = line + "\n"
+        size = len(data.encode('utf-8'))
+        with self.lock:
+            if self.current_file is None or (self.current_size > 0 and self.current_size + size > self.max_bytes):
+                self.open_next_file()
+            self.current_file.write(data)
+            self.custom_ids[self.paths[-1]].append(custom_id)
+            self.current_size = self.current_size + size
+            self.line_count = self.line_count + 1
+
+    # Close the last file and return the paths of every file written
+    def close(self):
+        with self.lock:
+            if self.current_file is not None:
+                self.current_file.close()
+                self.current_file = None
+            return list(self.paths)
+
+# Upload a JSONL file for the Batch API and return its file ID
+def upload_batch_file(path):
+    with open(path, 'rb') as batch_file:
+        response = requests.post(f"{OPENAI_API_BASE}/files", headers=openai_headers(),
+                                 data={'purpose': 'batch'}, files={'file': (os.path.basename(path), batch_file)},
+                                 timeout=GPT_BATCH_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['id']
+
+# Start a batch for an uploaded file and return the batch ID
+def create_batch(input_file_id):
+    payload = {
+        'input_file_id': input_file_id,
+        'endpoint': '/v1/chat/completions',
+        'completion_window': '24h'
+    }
+    response = requests.post(f"{OPENAI_API_BASE}/batches", headers=openai_headers(), json=payload, timeout=GPT_BATCH_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()['id']
+
+# Get the current state of a batch
+def get_batch(batch_id):
+    response = requests.get(f"{OPENAI_API_BASE}/batches/{batch_id}", headers=openai_headers(), timeout=GPT_BATCH_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+# Download a result file and return its JSONL lines as dicts
+def download_batch_results(file_id):
+    response = requests.get(f"{OPENAI_API_BASE}/files/{file_id}/content", headers=openai_headers(), timeout=GPT_BATCH_REQUEST_TIMEOUT)
+    response.raise_for_status()
+    results = []
+    for text_line in response.text.splitlines():
+        if text_line.strip():
+            results.append(json.loads(text_line))
+    return results
+
+# Validate each result with the normal title and tag checks. Returns custom_id -> listing data for the good ones
+def parse_batch_results(results):
+    listings = {}
+    for result in results:
+        custom_id = result.get('custom_id')
+        response = result.get('response') or {}
+        if result.get('error') is not None or response.get('status_code') != 200:
+            print("Batch request failed for:", custom_id)
+            continue
+        try:
+            content = response['body']['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            print("Batch result has no content for:", custom_id)
+            continue
+        listing_data = parse_listing_response(content)
+        if listing_data is not None:
+            listings[custom_id] = listing_data
+    return listings
+
+# True for errors that may go away if the same call is made again: network errors, timeouts, 429 and 5xx
+def is_transient_error(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+# Upload every batch file and start a batch for it. Each batch ID is saved in the journal as soon as OpenAI accepts it,
+# so if this run stops while waiting, the next one waits for the same batch instead of paying for it again.
+# custom_ids maps each path to the product folder IDs in it. Returns the batch IDs that were started
+def start_batches(paths, custom_ids):
+    batch_ids = []
+    for path in paths:
+        try:
+            input_file_id = upload_batch_file(path)
+            batch_id = create_batch(input_file_id)
+        except Exception as e:
+            print("Error starting GPT batch for", path, ":", e)
+            continue
+        record_batch(batch_id, custom_ids.get(path, []))
+        print("Submitted GPT batch:", batch_id)
+        batch_ids.append(batch_id)
+    return batch_ids
+
+# Stop waiting for a batch in this run. A batch that can not be checked at all (e.g. 404 or 401), or that
+# GPT_BATCH_MAX_FAILED_RUNS runs gave up on, is marked abandoned, so its products are queued again in the next batch.
+# Otherwise it stays unfinished in the journal and the next run resumes waiting for it
+def give_up_on_batch(batch_id, error, transient):
+    try:
+        failed_runs = record_batch_poll_failed(batch_id)
+        if not transient or failed_runs >= GPT_BATCH_MAX_FAILED_RUNS:
+            print("Abandoning GPT batch", batch_id, "- its products will be sent again:", error)
+            record_batch_finished(batch_id, 'abandoned')
+        else:
+            print("Giving up on GPT batch", batch_id, "for this run, the next run resumes it:", error)
+    except Exception as e:
+        print("Error recording GPT batch failure:", e)
+
+# Wait until every batch finishes and return custom_id -> validated listing data. Transient errors are retried on the
+# next poll, up to GPT_BATCH_POLL_RETRIES times in a row
+def wait_for_batches(batch_ids, poll_seconds=GPT_BATCH_POLL_SECONDS):
+    listings = {}
+    failed_polls = {}
+    pending = list(batch_ids)
+    while pending:
+        still_pending = []
+        for batch_id in pending:
+            try:
+                batch = get_batch(batch_id)
+                status = batch.get('status')
+                if status not in FINISHED_BATCH_STATES:
+                    failed_polls[batch_id] = 0
+                    still_pending.append(batch_id)
+                    continue
+                print("GPT batch", batch_id, "finished with status:", status)
+                # Even failed or expired batches can have finished some requests
+                if batch.get('output_file_id'):
+                    listings.update(parse_batch_results(download_batch_results(batch['output_file_id'])))
+                record_batch_finished(batch_id, status)
+            except Exception as e:
+                failed_polls[batch_id] = failed_polls.get(batch_id, 0) + 1
+                transient = is_transient_error(e)
+                if transient and failed_polls[batch_id] < GPT_BATCH_POLL_RETRIES:
+                    print("Error checking GPT batch", batch_id, "- trying again on the next poll:", e)
+                    still_pending.append(batch_id)
+                else:
+                    give_up_on_batch(batch_id, e, transient)
+        pending = still_pending
+        if pending:
+            print("Waiting for GPT batches:", len(pending))
+            time.sleep(poll_seconds)
+    return listings
+
+# Submit every batch file, wait until all batches finish, and return custom_id -> validated listing data.
+# Batches an earlier run started but never finished reading are waited for as well
+def submit_batch_files(paths, custom_ids, poll_seconds=GPT_BATCH_POLL_SECONDS):
+    try:
+        batch_ids = list(get_unfinished_batches())
+        if batch_ids:
+            print("Resuming GPT batches from an earlier run:", len(batch_ids))
+    except Exception as e:
+        print("Error reading unfinished GPT batches:", e)
+        batch_ids = []
+    batch_ids.extend(start_batches(paths, custom_ids))
+    return wait_for_batches(batch_ids, poll_seconds)
+
+# Test batch mode against the local fake OpenAI server, so no API key or network is needed.
+# Batch IDs go into a journal of their own, so the real journal and its unfinished batches are not touched
+def test_batch_generation():
+    global OPENAI_API_BASE
+    from fake_openai_server import start_fake_openai_server
+
+    print("=== Testing GPT Batch mode against the fake server ===")
+    server, base_url = start_fake_openai_server()
+    saved_base = OPENAI_API_BASE
+    saved_journal = job_journal.JOB_JOURNAL_FILE
+    OPENAI_API_BASE = base_url
+    test_journal = os.path.join(GPT_BATCH_DIR, 'test', 'test_journal.db')
+    os.makedirs(os.path.dirname(test_journal), exist_ok=True)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(test_journal + suffix):
+            os.remove(test_journal + suffix)
+    job_journal.reset_journal()
+    job_journal.JOB_JOURNAL_FILE = test_journal
+    try:
+        writer = BatchFileWriter(directory=os.path.join(GPT_BATCH_DIR, 'test'))
+        product_info = {'painting_title': 'Sunset', 'art_type': 'Original', 'size': '16x20', 'price': '150'}
+        test_image_path = os.path.join(GPT_BATCH_DIR, 'test', 'test_image.jpg')
+        os.makedirs(os.path.dirname(test_image_path), exist_ok=True)
+        with open(test_image_path, 'wb') as test_image:
+            test_image.write(b'\xff\xd8\xff\xe0' + b'\x00' * 64)
+        for index in range(3):
+            writer.add(f"product-{index}", make_batch_line(f"product-{index}", test_image_path, product_info))
+        listings = submit_batch_files(writer.close(), writer.custom_ids, poll_seconds=0.1)
+        print("Listings returned:", len(listings))
+        return len(listings) == 3
+    finally:
+        OPENAI_API_BASE = saved_base
+        job_journal.reset_journal()
+        job_journal.JOB_JOURNAL_FILE = saved_journal
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_batch_generation()
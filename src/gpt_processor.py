@@ -1,7 +1,15 @@
 import os
 import json
+import time
 import base64
 import openai
+from image_buffer import ImageBuffer
+from image_preprocessor import prepare_gpt_image
+from listing_stream import ListingStreamParser, check_listing_field
+from gpt_scheduler import get_gpt_scheduler
+from variant_index import VARIANT_REUSE_ENABLED, compute_image_hash, find_similar_listing, save_listing_hash, adapt_listing_to_variant
+from metrics import timed_stage, current_span, record_timing
+from listing_cache import LISTING_CACHE_BYPASS, hash_image, make_listing_cache_key, get_cached_listing, save_cached_listing
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -10,10 +18,29 @@ load_dotenv('config.env')
 # Set up OpenAI API key
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
-# Encode image to base64 for GPT-4 Vision API
+# Model used for the listing content
+GPT_MODEL = "gpt-4-vision-preview"
+
+# Change this whenever the prompt changes so cached results from the old prompt are not reused
+PROMPT_TEMPLATE_VERSION = "1"
+
+# Settings for the completion
+GPT_MAX_TOKENS = 1000
+GPT_TEMPERATURE = 0.7
+
+# Stream the completion and check the title and tags as soon as GPT finishes writing them. A response that breaks
+# the limits is dropped right there and asked for again, up to GPT_STREAM_MAX_ATTEMPTS times in total
+GPT_STREAMING = os.getenv("GPT_STREAMING", "false").lower() == "true"
+GPT_STREAM_MAX_ATTEMPTS = int(os.getenv("GPT_STREAM_MAX_ATTEMPTS", "2"))
+
+# Encode image to base64 for GPT-4 Vision API. image_path can also be an ImageBuffer that is already in memory
 def encode_image_to_base64(image_path):
     try:
         print("Encoding image to base64")
+        if isinstance(image_path, ImageBuffer):
+            text = image_path.encode_base64()
+            print("Image encoded successfully")
+            return text
         with open(image_path, "rb") as image_file:
             data = image_file.read()
         encoded = base64.b64encode(data)
@@ -63,20 +90,9 @@ def extract_product_info(product_folder_name):
         }
         return fallback
 
-# Generate Etsy listing content using GPT-4 Vision
-def generate_etsy_listing_content(image_path, product_folder_name):
-    try:
-        print("Generating Etsy listing content with GPT")
-        # Extract product information from folder name
-        product_info = extract_product_info(product_folder_name)
-        
-        # Encode image to base64 for GPT-4 Vision API
-        base64_image = encode_image_to_base64(image_path)
-        if base64_image is None:
-            print("Failed to encode image. Cannot call GPT")
-            return None, None
-        
-        prompt = f"""
+# Build the GPT prompt for one product
+def build_listing_prompt(product_info):
+    prompt = f"""
 You are an expert Etsy marketing specialist who creates compelling, search-optimized listings for original artwork and prints.
 
 ANALYZE THIS PAINTING AND CREATE AN ETSY LISTING:
@@ -113,64 +129,193 @@ REQUIREMENTS:
    - Size (small, medium, large, etc.)
 
 RESPOND IN THIS EXACT JSON FORMAT:
-{
+{{
     "title": "Your optimized title here (max 140 chars)",
     "description": "Your detailed description here",
     "tags": ["tag1", "tag2", "tag3", "tag4", "tag5", "tag6", "tag7", "tag8", "tag9", "tag10", "tag11", "tag12", "tag13"]
-}
+}}
 
 Focus on making this listing discoverable through Etsy search while accurately representing the artwork.
 """
+    return prompt
+
+# Check that the parsed listing has every field and meets Etsy's title and tag limits
+def validate_listing_data(listing_data):
+    has_title = 'title' in listing_data
+    has_description = 'description' in listing_data
+    has_tags = 'tags' in listing_data
+    if has_title and has_description and has_tags:
+        title_ok = len(listing_data['title']) <= 140
+        tags_ok = len(listing_data['tags']) == 13
+        if title_ok and tags_ok:
+            print("Validated GPT response")
+            return True
+        else:
+            print("Invalid response format: title length or tag count incorrect")
+            return False
+    else:
+        print("Missing required fields in GPT response")
+        return False
+
+# Build the chat completion request for one product. The same request is used for direct calls and the Batch API
+def build_chat_request(prompt, base64_image, image_mime_type):
+    request = {
+        "model": GPT_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{image_mime_type};base64,{base64_image}"
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": GPT_MAX_TOKENS,
+        "temperature": GPT_TEMPERATURE
+    }
+    return request
+
+# Cache key for the listing of this image and product
+def listing_cache_key(image_path, product_info):
+    return make_listing_cache_key(hash_image(image_path), product_info, PROMPT_TEMPLATE_VERSION, GPT_MODEL)
+
+# Parse and validate the JSON text GPT returned. Returns the listing data or None
+def parse_listing_response(content):
+    try:
+        listing_data = json.loads(content)
+    except json.JSONDecodeError:
+        print("Failed to parse JSON response from GPT")
+        return None
+    if not isinstance(listing_data, dict) or not validate_listing_data(listing_data):
+        return None
+    return listing_data
+
+# Hash of the image for variant reuse, or None when variant reuse is off
+def variant_image_hash(image_path):
+    if not VARIANT_REUSE_ENABLED:
+        return None
+    return compute_image_hash(image_path)
+
+# Reuse the listing of a near-identical image with this product's size and art type swapped in.
+# Returns None if there is no such listing or the swapped version does not pass validation
+def find_variant_listing(image_hash, product_info):
+    listing_data, source_info = find_similar_listing(image_hash, product_info)
+    if listing_data is None:
+        return None
+    adapted = adapt_listing_to_variant(listing_data, source_info, product_info)
+    if not validate_listing_data(adapted):
+        return None
+    return adapted
+
+# One streamed GPT call. Returns the full response text, or None if a field broke the limits and the stream was stopped.
+# Records how long the first token and the first complete field took
+def stream_listing_attempt(chat_request):
+    start_time = time.perf_counter()
+    parser = ListingStreamParser()
+    first_field_seen = False
+    response = get_gpt_scheduler().run(chat_request, lambda: openai.ChatCompletion.create(stream=True, **chat_request))
+    try:
+        for chunk in response:
+            choices = chunk.get('choices') or [{}]
+            text = choices[0].get('delta', {}).get('content')
+            if not text:
+                continue
+            if not parser.text:
+                record_timing('gpt_first_token', time.perf_counter() - start_time)
+            for field in parser.feed(text):
+                if not first_field_seen:
+                    first_field_seen = True
+                    record_timing('gpt_first_field', time.perf_counter() - start_time, field=field)
+                problem = check_listing_field(field, parser.fields[field])
+                if problem is not None:
+                    print("Stopping GPT stream early:", problem)
+                    return None
+        return parser.text
+    finally:
+        # Closing the stream drops the connection, so GPT stops writing the rest of a response we will not use
+        if hasattr(response, 'close'):
+            response.close()
+
+# Stream the completion, starting over when a field breaks the limits. Returns the response text or None
+def stream_listing_content(chat_request):
+    for attempt in range(GPT_STREAM_MAX_ATTEMPTS):
+        if attempt > 0:
+            print("Asking GPT again. Attempt:", attempt + 1)
+            current_span().add_retries(1)
+        content = stream_listing_attempt(chat_request)
+        if content is not None:
+            return content
+    return None
+
+# Generate Etsy listing content using GPT-4 Vision. Results are cached by image and product info unless use_cache is False
+@timed_stage('gpt_generate')
+def generate_etsy_listing_content(image_path, product_folder_name, use_cache=None):
+    try:
+        print("Generating Etsy listing content with GPT")
+        # Extract product information from folder name
+        product_info = extract_product_info(product_folder_name)
+
+        # Reuse an earlier validated result for the same image, product info, prompt and model
+        if use_cache is None:
+            use_cache = not LISTING_CACHE_BYPASS
+        if use_cache:
+            cache_key = listing_cache_key(image_path, product_info)
+            listing_data = get_cached_listing(cache_key)
+            if listing_data is not None:
+                current_span().set_outcome("cache_hit")
+                return listing_data, product_info
+
+        # Another size or print of the same painting may already have a listing we can reuse
+        image_hash = variant_image_hash(image_path)
+        if image_hash is not None:
+            listing_data = find_variant_listing(image_hash, product_info)
+            if listing_data is not None:
+                current_span().set_outcome("variant_reuse")
+                if use_cache:
+                    save_cached_listing(cache_key, listing_data)
+                return listing_data, product_info
+        
+        # Make a smaller copy of the image for GPT and encode it to base64 for GPT-4 Vision API
+        base64_image, image_mime_type = prepare_gpt_image(image_path)
+        if base64_image is None:
+            print("Failed to encode image. Cannot call GPT")
+            return None, None
+        
+        current_span().add_bytes(len(base64_image))
+        prompt = build_listing_prompt(product_info)
         
         print("Calling GPT-4 Vision API")
-        # Call GPT-4 Vision API
-        response = openai.ChatCompletion.create(
-            model="gpt-4-vision-preview",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
+        chat_request = build_chat_request(prompt, base64_image, image_mime_type)
+        if GPT_STREAMING:
+            content = stream_listing_content(chat_request)
+            if content is None:
+                current_span().set_outcome("invalid_response")
+                return None, None
+        else:
+            # Call GPT-4 Vision API. The scheduler holds the call back until it fits the OpenAI rate limits
+            response = get_gpt_scheduler().run(chat_request, lambda: openai.ChatCompletion.create(**chat_request))
+            # Extract the response content (text)
+            content = response.choices[0].message.content
         print("Received response from GPT")
-        # Extract the response content (text)
-        content = response.choices[0].message.content
         print("Parsing GPT response JSON")
         
 
         # Validate the response
-        try:
-            listing_data = json.loads(content)
-            has_title = 'title' in listing_data
-            has_description = 'description' in listing_data
-            has_tags = 'tags' in listing_data
-            if has_title and has_description and has_tags:
-                title_ok = len(listing_data['title']) <= 140
-                tags_ok = len(listing_data['tags']) == 13
-                if title_ok and tags_ok:
-                    print("Validated GPT response")
-                    # Return both listing data and product info
-                    return listing_data, product_info
-                else:
-                    print("Invalid response format: title length or tag count incorrect")
-                    return None, None
-            else:
-                print("Missing required fields in GPT response")
-                return None, None
-        except json.JSONDecodeError:
-            print("Failed to parse JSON response from GPT")
+        listing_data = parse_listing_response(content)
+        if listing_data is None:
+            current_span().set_outcome("invalid_response")
             return None, None
+        if use_cache:
+            save_cached_listing(cache_key, listing_data)
+        if image_hash is not None:
+            save_listing_hash(image_hash, product_info, listing_data)
+        # Return both listing data and product info
+        return listing_data, product_info
         
     except Exception as e:
         print("Error generating Etsy listing content:", e)
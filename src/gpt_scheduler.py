@@ -0,0 +1,195 @@
+import io
+import os
+import re
+import math
+import time
+import base64
+import random
+import threading
+from collections import deque
+import openai
+from metrics import current_span, set_gauge
+from dotenv import load_dotenv
+
+# Pillow is only needed to read the image size for the token estimate. Without it every image counts as a full-size one
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# The account's OpenAI limits for the model. Requests wait here until they fit, instead of being sent and rejected with 429
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "30000"))
+
+# How many times a request is sent again after OpenAI still answers 429
+OPENAI_MAX_RATE_LIMIT_RETRIES = int(os.getenv("OPENAI_MAX_RATE_LIMIT_RETRIES", "4"))
+
+# Token cost of an image when its size can not be read: a high detail 1024x1024 image
+DEFAULT_IMAGE_TOKENS = 765
+
+# Token cost of a high detail image. OpenAI fits it in 2048x2048, shrinks the short side to 768,
+# then charges 170 tokens for every 512 pixel tile plus 85
+def estimate_image_tokens(width, height, detail='high'):
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+# Token cost of one data: URL image. Only the image header is decoded to read its size
+def estimate_data_url_tokens(url, detail):
+    if Image is None or not url.startswith('data:'):
+        return DEFAULT_IMAGE_TOKENS
+    try:
+        data = base64.b64decode(url.split(',', 1)[1])
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+        return estimate_image_tokens(width, height, detail)
+    except Exception:
+        return DEFAULT_IMAGE_TOKENS
+
+# Tokens a chat request can use at most: its text (about 4 characters per token), its images and max_tokens.
+# OpenAI counts max_tokens against the per-minute budget when the request arrives, so we do too
+def estimate_request_tokens(chat_request):
+    text_characters = 0
+    image_tokens = 0
+    for message in chat_request.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            text_characters = text_characters + len(content)
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                text_characters = text_characters + len(part.get('text', ''))
+            elif part.get('type') == 'image_url':
+                image_url = part.get('image_url', {})
+                image_tokens = image_tokens + estimate_data_url_tokens(image_url.get('url', ''), image_url.get('detail', 'high'))
+    return text_characters // 4 + image_tokens + chat_request.get('max_tokens', 0)
+
+# Turn OpenAI's reset times like "1s", "6m0s" or "250ms" into seconds
+def parse_reset_duration(text):
+    seconds = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|s|m|h)', text or ''):
+        seconds = seconds + float(amount) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return seconds
+
+# Seconds to wait after a 429, from Retry-After or the rate limit reset headers, otherwise backoff with jitter
+def rate_limit_delay(headers, attempt):
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    retry_after = headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    reset = max(parse_reset_duration(headers.get('x-ratelimit-reset-requests')),
+                parse_reset_duration(headers.get('x-ratelimit-reset-tokens')))
+    if reset > 0:
+        return reset
+    return min(60.0, (2 ** attempt) * 1.0) * random.uniform(0.5, 1.5)
+
+# Admits GPT requests against the per-minute request and token budgets. Both budgets refill continuously,
+# so requests go out as fast as the limits allow. Shared by every thread
+class GptScheduler:
+    def __init__(self, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE, tokens_per_minute=OPENAI_TOKENS_PER_MINUTE):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_available = float(requests_per_minute)
+        self.tokens_available = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        # (time, tokens) of every request admitted in the last minute
+        self.admitted = deque()
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = now - self.last_refill
+        self.requests_available = min(self.requests_per_minute, self.requests_available + elapsed * self.requests_per_minute / 60)
+        self.tokens_available = min(self.tokens_per_minute, self.tokens_available + elapsed * self.tokens_per_minute / 60)
+        self.last_refill = now
+
+    # Wait until one request of this many tokens fits in both budgets, then take it out of them
+    def acquire(self, tokens):
+        # A request bigger than the whole token budget would never fit, so it waits for a full budget instead
+        tokens = min(tokens, self.tokens_per_minute)
+        with self.lock:
+            self.waiting = self.waiting + 1
+            set_gauge('gpt_queue_depth', self.waiting)
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self.refill(now)
+                    wait = self.paused_until - now
+                    if wait <= 0:
+                        if self.requests_available >= 1 and self.tokens_available >= tokens:
+                            self.requests_available = self.requests_available - 1
+                            self.tokens_available = self.tokens_available - tokens
+                            self.admitted.append((now, tokens))
+                            set_gauge('gpt_tokens_per_minute', self.tokens_last_minute(now))
+                            return
+                        wait = max((1 - self.requests_available) * 60 / self.requests_per_minute,
+                                   (tokens - self.tokens_available) * 60 / self.tokens_per_minute)
+                # Wake up at least once a second in case a pause was lifted or the budgets changed
+                time.sleep(min(max(wait, 0.01), 1.0))
+        finally:
+            with self.lock:
+                self.waiting = self.waiting - 1
+                set_gauge('gpt_queue_depth', self.waiting)
+
+    # Stop admitting anything for the given number of seconds and empty the budgets, because OpenAI says we are over them
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.requests_available = min(self.requests_available, 0.0)
+            self.tokens_available = min(self.tokens_available, 0.0)
+
+    # Tokens admitted in the 60 seconds before now. Call with the lock held
+    def tokens_last_minute(self, now):
+        while self.admitted and self.admitted[0][0] < now - 60:
+            self.admitted.popleft()
+        return sum(tokens for admitted_time, tokens in self.admitted)
+
+    # Queue depth and the tokens and requests admitted in the last minute
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            tokens = self.tokens_last_minute(now)
+            return {'queue_depth': self.waiting, 'tokens_per_minute': tokens, 'requests_per_minute': len(self.admitted)}
+
+    # Send one chat request through the scheduler. call() makes the actual request. A 429 pauses every thread
+    # for as long as OpenAI asks and the request is sent again, up to OPENAI_MAX_RATE_LIMIT_RETRIES times
+    def run(self, chat_request, call):
+        tokens = estimate_request_tokens(chat_request)
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                return call()
+            except openai.error.RateLimitError as e:
+                if attempt >= OPENAI_MAX_RATE_LIMIT_RETRIES:
+                    raise
+                delay = rate_limit_delay(getattr(e, 'headers', None), attempt)
+                print("OpenAI rate limit hit, waiting", round(delay, 1), "seconds")
+                current_span().add_retries(1)
+                self.pause(delay)
+                attempt = attempt + 1
+
+# One scheduler is shared by all threads so they share the budgets
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+# Get the shared GPT scheduler
+def get_gpt_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = GptScheduler()
+        return _scheduler
@@ -0,0 +1,74 @@
+import io
+import os
+import base64
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Largest image we are willing to hold in memory. Downloads bigger than this fail instead of using more memory
+MAX_IMAGE_BUFFER_BYTES = int(os.getenv("MAX_IMAGE_BUFFER_BYTES", str(200 * 1024 * 1024)))
+
+# Raised when an image does not fit in the buffer
+class ImageBufferFullError(Exception):
+    pass
+
+# Holds one downloaded image in memory so the GPT and Etsy stages can use the same bytes without reading the disk again.
+# A worker keeps one buffer and calls reset() before each new image so the memory gets reused
+class ImageBuffer:
+    def __init__(self, file_name=None, max_bytes=MAX_IMAGE_BUFFER_BYTES):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.data = io.BytesIO()
+        self.size = 0
+        # Biggest image this buffer has held, so peak memory per image can be checked
+        self.peak_bytes = 0
+
+    # Empty the buffer so it can hold the next image
+    def reset(self, file_name=None):
+        self.file_name = file_name
+        self.data.seek(0)
+        self.data.truncate(0)
+        self.size = 0
+
+    # MediaIoBaseDownload writes the downloaded chunks here
+    def write(self, chunk):
+        if self.size + len(chunk) > self.max_bytes:
+            raise ImageBufferFullError(f"Image is bigger than the {self.max_bytes} byte buffer limit")
+        written = self.data.write(chunk)
+        self.size = self.size + written
+        if self.size > self.peak_bytes:
+            self.peak_bytes = self.size
+        return written
+
+    # Base64 text of the image for the GPT request. Reads the bytes in place without copying them first
+    def encode_base64(self):
+        with self.data.getbuffer() as view:
+            return base64.b64encode(view).decode('utf-8')
+
+    # File-like object positioned at the start of the image, for the Etsy multipart upload
+    def open_for_upload(self):
+        self.data.seek(0)
+        return self.data
+
+    # Rough peak memory for the current image. The raw bytes are read in place, never copied. Without max_dimension the
+    # whole original is base64 encoded for GPT. With it, the JPEG is decoded at no more than about twice that size per
+    # side, and only the small rendition is base64 encoded
+    def estimated_peak_memory(self, max_dimension=None):
+        if max_dimension is None:
+            return self.size + ((self.size + 2) // 3) * 4
+        decoded_size = (2 * max_dimension) * (2 * max_dimension) * 3
+        rendition_size = min(self.size, max_dimension * max_dimension)
+        return self.size + decoded_size + ((rendition_size + 2) // 3) * 4
+
+# Each worker thread keeps one buffer that it reuses for every image
+_thread_local = threading.local()
+
+# Get the reusable image buffer for the current thread
+def get_thread_image_buffer():
+    image_buffer = getattr(_thread_local, 'image_buffer', None)
+    if image_buffer is None:
+        image_buffer = ImageBuffer()
+        _thread_local.image_buffer = image_buffer
+    return image_buffer
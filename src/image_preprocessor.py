@@ -0,0 +1,126 @@
+import io
+import os
+import contextlib
+import base64
+import hashlib
+from image_buffer import ImageBuffer
+from disk_cache import write_file_atomically, touch_file, evict_oldest_files
+from dotenv import load_dotenv
+
+# Pillow is only needed for resizing. Without it the original image is sent to GPT
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Settings for the smaller copy of the image that is sent to GPT. Etsy still gets the original
+GPT_IMAGE_MAX_DIMENSION = int(os.getenv("GPT_IMAGE_MAX_DIMENSION", "1536"))
+GPT_IMAGE_JPEG_QUALITY = int(os.getenv("GPT_IMAGE_JPEG_QUALITY", "85"))
+
+# Resized copies are cached here so a retry does not resize the same image again
+GPT_RENDITION_CACHE_DIR = os.getenv("GPT_RENDITION_CACHE_DIR", "gpt_image_renditions")
+GPT_RENDITION_CACHE_MAX_BYTES = int(os.getenv("GPT_RENDITION_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Raw bytes of an image from a file path or an ImageBuffer. An ImageBuffer's bytes are lent as a view instead of
+# being copied, so only use them inside the with block
+@contextlib.contextmanager
+def image_bytes(image_source):
+    if isinstance(image_source, ImageBuffer):
+        with image_source.data.getbuffer() as view:
+            yield view
+    else:
+        with open(image_source, 'rb') as image_file:
+            yield image_file.read()
+
+# What to hand Pillow's Image.open for an image: the file path, or the ImageBuffer's own stream, so Pillow reads
+# the bytes where they are instead of from a copy
+def pillow_source(image_source):
+    if isinstance(image_source, ImageBuffer):
+        image_source.data.seek(0)
+        return image_source.data
+    return image_source
+
+# Longest side of the resized copy GPT gets, or None when Pillow is missing and the original is sent
+def gpt_rendition_max_dimension():
+    if Image is None:
+        return None
+    return GPT_IMAGE_MAX_DIMENSION
+
+# Work out the MIME type from the first bytes of the image instead of trusting the file name
+def guess_image_mime_type(data):
+    data = bytes(data[:12])
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'GIF87a') or data.startswith(b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+# Resize, rotate and re-encode the image as a JPEG no bigger than GPT_IMAGE_MAX_DIMENSION on its longest side
+def make_gpt_rendition(image_source):
+    with Image.open(pillow_source(image_source)) as original:
+        # JPEGs can be decoded at 1/2, 1/4 or 1/8 of their size, so a 40 MP original is never decoded in full
+        original.draft('RGB', (GPT_IMAGE_MAX_DIMENSION, GPT_IMAGE_MAX_DIMENSION))
+        # Apply the EXIF orientation so GPT sees the painting the right way up
+        image = ImageOps.exif_transpose(original)
+
+    # JPEG has no transparency, so put transparent images on a white background
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    image.thumbnail((GPT_IMAGE_MAX_DIMENSION, GPT_IMAGE_MAX_DIMENSION), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=GPT_IMAGE_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+# Returns the base64 text and MIME type of the image to send to GPT
+def prepare_gpt_image(image_source):
+    try:
+        print("Preparing image for GPT")
+        with image_bytes(image_source) as data:
+            return prepare_gpt_image_data(image_source, data)
+    except Exception as e:
+        print("Error in prepare_gpt_image:", e)
+        return None, None
+
+# prepare_gpt_image for image bytes that are already read, or lent by an ImageBuffer
+def prepare_gpt_image_data(image_source, data):
+    if Image is None:
+        print("Pillow not installed. Sending the original image")
+        return base64.b64encode(data).decode('utf-8'), guess_image_mime_type(data)
+
+    # The cache key covers the image and the settings, so changing a setting makes a new rendition
+    hasher = hashlib.sha256(data)
+    hasher.update(f"{GPT_IMAGE_MAX_DIMENSION}:{GPT_IMAGE_JPEG_QUALITY}".encode('utf-8'))
+    cache_path = os.path.join(GPT_RENDITION_CACHE_DIR, hasher.hexdigest() + ".jpg")
+
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cached_file:
+            rendition = cached_file.read()
+        touch_file(cache_path)
+        print("Using cached GPT rendition")
+    else:
+        try:
+            rendition = make_gpt_rendition(image_source)
+        except Exception as e:
+            print("Could not resize image. Sending the original image:", e)
+            return base64.b64encode(data).decode('utf-8'), guess_image_mime_type(data)
+        if not os.path.exists(GPT_RENDITION_CACHE_DIR):
+            os.makedirs(GPT_RENDITION_CACHE_DIR, exist_ok=True)
+        write_file_atomically(cache_path, rendition)
+        evict_oldest_files(GPT_RENDITION_CACHE_DIR, GPT_RENDITION_CACHE_MAX_BYTES)
+        print("Created GPT rendition. Original bytes:", len(data), "Rendition bytes:", len(rendition))
+
+    return base64.b64encode(rendition).decode('utf-8'), 'image/jpeg'
@@ -0,0 +1,72 @@
+import os
+import uuid
+import hashlib
+from disk_cache import evict_oldest_files
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Downloaded originals are kept here under their Drive md5Checksum, so a retry or a rerun uses the local copy
+# instead of downloading the file again
+IMAGE_STORE_ENABLED = os.getenv("IMAGE_STORE_ENABLED", "true").lower() == "true"
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+
+# Total size of the store. The least recently used images are deleted above it. Keep it well above
+# (workers x largest image) so an image is never evicted while another product is still using it
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Downloads in progress go in here, so eviction never sees a half written file
+INCOMING_DIR = os.path.join(IMAGE_STORE_DIR, "incoming")
+
+# Path of a stored image. The original extension is kept so anything that looks at the file name still works
+def stored_image_path(md5_checksum, file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    return os.path.join(IMAGE_STORE_DIR, md5_checksum.lower() + extension)
+
+# Path of the stored copy of an image, or None if it is not in the store
+def get_stored_image(md5_checksum, file_name):
+    path = stored_image_path(md5_checksum, file_name)
+    try:
+        # Marks it as just used. Fails if the file is missing, or was evicted by another thread since it was found
+        os.utime(path, None)
+    except OSError:
+        return None
+    return path
+
+# A new temp file path for one download
+def new_incoming_path():
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    return os.path.join(INCOMING_DIR, uuid.uuid4().hex + ".part")
+
+# Path for a ranged download of a large image. It is named after the checksum, not a random name,
+# so an interrupted download is found again and resumed on the next run
+def partial_download_path(md5_checksum):
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    return os.path.join(INCOMING_DIR, md5_checksum.lower() + ".partial")
+
+# Writes a download to a file and works out its MD5 on the way, so checking it does not read the file again
+class HashingFileWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+# Move a finished download into the store if its MD5 matches the one Drive reported. A file that does not
+# match is deleted. Returns the stored path, or None if the check failed
+def add_to_store(incoming_path, actual_md5, md5_checksum, file_name):
+    if actual_md5.lower() != md5_checksum.lower():
+        print("Downloaded file does not match its Drive checksum:", file_name)
+        os.remove(incoming_path)
+        return None
+    path = stored_image_path(md5_checksum, file_name)
+    # Another thread may have stored the same image already. Replacing it with identical bytes is harmless
+    os.replace(incoming_path, path)
+    evict_oldest_files(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES, keep=[path])
+    return path
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import weakref
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# SQLite file that remembers how far each product folder got, so a failed run can resume at the failed stage
+JOB_JOURNAL_FILE = os.getenv("JOB_JOURNAL_FILE", "job_journal.db")
+
+# Pipeline stages in the order they happen
+STAGES = ['discovered', 'downloaded', 'generated', 'image_uploaded', 'listing_created', 'image_associated', 'moved']
+
+# Every thread keeps one open connection to the journal and reuses it. It is held through a JournalHandle, which
+# Python drops when the thread ends, and dropping the handle closes the connection. Worker pools are built again
+# for every daemon poll, so without this each poll would leave one open connection per worker behind
+_thread_local = threading.local()
+
+class JournalHandle:
+    def __init__(self, connection, generation):
+        self.connection = connection
+        self.generation = generation
+        weakref.finalize(self, close_connection, connection)
+
+# All connections that are open, so reset_journal can close them. Bumping the generation makes every thread reopen
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+_schema_ready = False
+
+# Create the table the first time, and add columns that older journals do not have
+def create_schema(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            product_folder_id TEXT PRIMARY KEY,
+            product_folder_name TEXT,
+            stage TEXT NOT NULL,
+            listing_data TEXT,
+            product_info TEXT,
+            image_id TEXT,
+            image_ids TEXT,
+            listing_id TEXT,
+            published TEXT,
+            error TEXT,
+            updated_at REAL
+        )
+    """)
+    # Journals made before multi-image products do not have the image_ids column yet
+    columns = [row['name'] for row in connection.execute("PRAGMA table_info(jobs)")]
+    if 'image_ids' not in columns:
+        connection.execute("ALTER TABLE jobs ADD COLUMN image_ids TEXT")
+    # Nor the marketplaces a product was published to
+    if 'published' not in columns:
+        connection.execute("ALTER TABLE jobs ADD COLUMN published TEXT")
+    # OpenAI batches that were started, so a run that stops while waiting can pick them up again
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS gpt_batches (
+            batch_id TEXT PRIMARY KEY,
+            custom_ids TEXT NOT NULL,
+            status TEXT NOT NULL,
+            failed_runs INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL
+        )
+    """)
+    columns = [row['name'] for row in connection.execute("PRAGMA table_info(gpt_batches)")]
+    if 'failed_runs' not in columns:
+        connection.execute("ALTER TABLE gpt_batches ADD COLUMN failed_runs INTEGER NOT NULL DEFAULT 0")
+    connection.commit()
+
+# Close one journal connection and forget it. Called when its thread ends, or from reset_journal
+def close_connection(connection):
+    with _connections_lock:
+        if connection in _connections:
+            _connections.remove(connection)
+    connection.close()
+
+# Get this thread's journal connection, opening it the first time. WAL mode lets readers and the writer work at
+# the same time, so only writers wait for each other. The schema is checked once per process, not on every call
+def open_journal():
+    global _schema_ready
+    handle = getattr(_thread_local, 'handle', None)
+    if handle is not None and handle.generation == _generation:
+        return handle.connection
+    # The connection is only ever used by this thread. check_same_thread is off so it can be closed from elsewhere
+    connection = sqlite3.connect(JOB_JOURNAL_FILE, timeout=30, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only gives up the last commits on a power cut, never consistency, and saves an fsync per write
+    connection.execute("PRAGMA synchronous=NORMAL")
+    with _connections_lock:
+        if not _schema_ready:
+            create_schema(connection)
+            _schema_ready = True
+        _connections.append(connection)
+        _thread_local.handle = JournalHandle(connection, _generation)
+    return connection
+
+# Close every journal connection, so the file can be deleted or replaced. Only call it while nothing is using the journal
+def reset_journal():
+    global _generation, _schema_ready
+    with _connections_lock:
+        for connection in _connections:
+            connection.close()
+        _connections.clear()
+        _generation = _generation + 1
+        _schema_ready = False
+
+# Returns the job for a product folder as a dict, or None if we have never seen it
+def get_job(product_folder_id):
+    connection = open_journal()
+    row = connection.execute("SELECT * FROM jobs WHERE product_folder_id = ?", (product_folder_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    if job['listing_data'] is not None:
+        job['listing_data'] = json.loads(job['listing_data'])
+    if job['product_info'] is not None:
+        job['product_info'] = json.loads(job['product_info'])
+    # Etsy image IDs of every uploaded image, keyed by Drive file ID
+    if job['image_ids'] is not None:
+        job['image_ids'] = json.loads(job['image_ids'])
+    else:
+        job['image_ids'] = {}
+    # Names of the marketplaces that finished publishing this product
+    job['published'] = json.loads(job['published']) if job['published'] is not None else []
+    return job
+
+# True if the job already finished the given stage
+def stage_reached(job, stage):
+    if job is None:
+        return False
+    return STAGES.index(job['stage']) >= STAGES.index(stage)
+
+# Record that a product folder finished a stage, together with any outputs of that stage.
+# The stage never moves backwards and outputs that are not given keep their saved value.
+# image_ids is merged into the saved IDs, so uploads that finished before a failure are kept
+def record_stage(product_folder_id, product_folder_name, stage, listing_data=None, product_info=None, image_id=None, listing_id=None, image_ids=None):
+    connection = open_journal()
+    with connection:
+        # Take the write lock before reading so two threads can not both merge into the old value
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute("SELECT stage, image_ids FROM jobs WHERE product_folder_id = ?", (product_folder_id,)).fetchone()
+        if row is not None and STAGES.index(row['stage']) > STAGES.index(stage):
+            stage = row['stage']
+        image_ids_json = None
+        if image_ids is not None:
+            saved_image_ids = {}
+            if row is not None and row['image_ids'] is not None:
+                saved_image_ids = json.loads(row['image_ids'])
+            saved_image_ids.update({file_id: str(value) for file_id, value in image_ids.items()})
+            image_ids_json = json.dumps(saved_image_ids)
+        listing_json = json.dumps(listing_data) if listing_data is not None else None
+        product_json = json.dumps(product_info) if product_info is not None else None
+        image_text = str(image_id) if image_id is not None else None
+        listing_text = str(listing_id) if listing_id is not None else None
+        connection.execute("""
+            INSERT INTO jobs (product_folder_id, product_folder_name, stage, listing_data, product_info, image_id, image_ids, listing_id, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)
+            ON CONFLICT(product_folder_id) DO UPDATE SET
+                product_folder_name = excluded.product_folder_name,
+                stage = excluded.stage,
+                listing_data = COALESCE(excluded.listing_data, jobs.listing_data),
+                product_info = COALESCE(excluded.product_info, jobs.product_info),
+                image_id = COALESCE(excluded.image_id, jobs.image_id),
+                image_ids = COALESCE(excluded.image_ids, jobs.image_ids),
+                listing_id = COALESCE(excluded.listing_id, jobs.listing_id),
+                error = NULL,
+                updated_at = excluded.updated_at
+        """, (product_folder_id, product_folder_name, stage, listing_json, product_json, image_text, image_ids_json, listing_text, time.time()))
+    print("Journal stage for", product_folder_name, "is now:", stage)
+
+# Record that a product finished publishing to one marketplace, so a retry after another marketplace failed
+# does not publish to it again
+def record_published(product_folder_id, marketplace):
+    connection = open_journal()
+    with connection:
+        # Take the write lock before reading so marketplaces finishing at the same time do not drop each other
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute("SELECT published FROM jobs WHERE product_folder_id = ?", (product_folder_id,)).fetchone()
+        published = json.loads(row['published']) if row is not None and row['published'] is not None else []
+        if marketplace not in published:
+            published.append(marketplace)
+        connection.execute("UPDATE jobs SET published = ?, updated_at = ? WHERE product_folder_id = ?",
+                           (json.dumps(published), time.time(), product_folder_id))
+
+# Save why a product folder failed. The stage stays where it was so the next run resumes there
+def record_error(product_folder_id, error):
+    connection = open_journal()
+    with connection:
+        connection.execute("UPDATE jobs SET error = ?, updated_at = ? WHERE product_folder_id = ?",
+                           (error, time.time(), product_folder_id))
+
+# Remember a batch as soon as OpenAI accepted it, along with the product folder IDs it generates content for
+def record_batch(batch_id, custom_ids):
+    connection = open_journal()
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO gpt_batches (batch_id, custom_ids, status, updated_at) VALUES (?, ?, 'submitted', ?)",
+                           (batch_id, json.dumps(list(custom_ids)), time.time()))
+
+# Count a run that gave up waiting for a batch. Returns how many runs have given up on it so far
+def record_batch_poll_failed(batch_id):
+    connection = open_journal()
+    with connection:
+        connection.execute("UPDATE gpt_batches SET failed_runs = failed_runs + 1, updated_at = ? WHERE batch_id = ?", (time.time(), batch_id))
+        row = connection.execute("SELECT failed_runs FROM gpt_batches WHERE batch_id = ?", (batch_id,)).fetchone()
+    return row['failed_runs'] if row is not None else 0
+
+# Mark a batch as finished once its results were read, or as abandoned, so it is not waited for again
+def record_batch_finished(batch_id, status):
+    connection = open_journal()
+    with connection:
+        connection.execute("UPDATE gpt_batches SET status = ?, updated_at = ? WHERE batch_id = ?", (status, time.time(), batch_id))
+
+# Batches started by an earlier run whose results were never read. Returns batch ID -> product folder IDs
+def get_unfinished_batches():
+    connection = open_journal()
+    rows = connection.execute("SELECT batch_id, custom_ids FROM gpt_batches WHERE status = 'submitted' ORDER BY updated_at").fetchall()
+    return {row['batch_id']: json.loads(row['custom_ids']) for row in rows}
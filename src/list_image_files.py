@@ -1,52 +1,109 @@
+import os
+from metrics import timed_stage
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Drive returns at most 1000 files per page
+PAGE_SIZE = 1000
+
+# How many product folders we ask about in one query. Keeps the query string well under the URL length limit
+FOLDERS_PER_QUERY = 40
+
+# Only ask Drive for the fields the pipeline uses
+# parents lets the move to Processed skip looking up each folder's parent again
+FOLDER_FIELDS = "nextPageToken, files(id, name, parents)"
+# thumbnailLink and imageMediaMetadata let the GPT stage use a Drive thumbnail instead of the full original.
+# md5Checksum is the key of the local image store and checks each download
+IMAGE_FIELDS = "nextPageToken, files(id, name, parents, md5Checksum, size, thumbnailLink, imageMediaMetadata(width, height, rotation))"
+
+# Order of the images inside a product folder. "name" sorts by file name (e.g. 1_front.jpg, 2_detail.jpg),
+# "drive" keeps the order Drive returns. The first image is the main one GPT looks at and Etsy shows first
+IMAGE_RANK_ORDER = os.getenv("IMAGE_RANK_ORDER", "name")
+
+# Numbers from the last listing run so we can see how many API calls it took per image
+last_listing_stats = {'api_calls': 0, 'product_folders': 0, 'images': 0}
+
+# Run a files().list query and follow nextPageToken until every page has been read
+def list_all_files(service, query, fields, stats):
+    files = []
+    page_token = None
+    while True:
+        results = service.files().list(q=query, fields=fields, pageSize=PAGE_SIZE, pageToken=page_token).execute()
+        stats['api_calls'] = stats['api_calls'] + 1
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if page_token is None:
+            return files
+
+# Returns the main image of every given product folder, asking about many folders in each query.
+# Each returned image also has product_images: every image in the folder in rank order, main image first
+def list_images_in_folders(service, product_folders, stats=None):
+    if stats is None:
+        stats = {'api_calls': 0}
+
+    # Remember which product folder each ID belongs to so images can be matched back to their folder
+    folders_by_id = {}
+    for product_folder in product_folders:
+        folders_by_id[product_folder['id']] = product_folder
+
+    # Collect the images of each folder, keeping the order Drive returned them in
+    images_by_folder = {}
+    folder_ids = list(folders_by_id.keys())
+    for start in range(0, len(folder_ids), FOLDERS_PER_QUERY):
+        chunk = folder_ids[start:start + FOLDERS_PER_QUERY]
+        parent_clauses = " or ".join(f"'{folder_id}' in parents" for folder_id in chunk)
+        # Looks for images that are direct children of any folder in this chunk ( change the image/ to a different file type if the file type is different)
+        image_query = f"({parent_clauses}) and mimeType contains 'image/'"
+        images = list_all_files(service, image_query, IMAGE_FIELDS, stats)
+        for image in images:
+            for parent_id in image.get('parents', []):
+                if parent_id in folders_by_id:
+                    images_by_folder.setdefault(parent_id, []).append(image)
+
+    all_images = []
+    for folder_id in folder_ids:
+        images = images_by_folder.get(folder_id, [])
+        print("Images found in a folder:", len(images))
+        if images:
+            if IMAGE_RANK_ORDER == "name":
+                images = sorted(images, key=lambda item: item['name'].lower())
+            image = dict(images[0])
+            # Add the product folder name and ID to the image data
+            image['product_folder_name'] = folders_by_id[folder_id]['name']
+            image['product_folder_id'] = folder_id
+            image['product_folder_parent_id'] = (folders_by_id[folder_id].get('parents') or [None])[0]
+            image['product_images'] = images
+            all_images.append(image)
+    return all_images
 
 # Returns a list of all images found across all product folders
+@timed_stage('drive_listing')
 def list_image_files(service, folder_id):
     try:
         print("Listing images from Unprocessed folder")
-        # We need to find the folders first, then get the image from inside each folder
+        stats = {'api_calls': 0}
+
+        # We need to find the folders first, then get the images from inside them
         folder_query = f"'{folder_id}' in parents and mimeType='application/vnd.google-apps.folder'"
-        
-        # Get all product folders (raw data)
-        folder_results = service.files().list(q=folder_query, fields="files(id, name)").execute()
-        
-        # Extract the list of product folders from the results (Just the folders)
-        # If no folders found, this will be an empty list
-        product_folders = folder_results.get('files', [])
+        product_folders = list_all_files(service, folder_query, FOLDER_FIELDS, stats)
         count_product_folders = len(product_folders)
         print("Found product folders:", count_product_folders)
-        
-        # Create a list to store all images we find
-        all_images = []
-        
-        # Loop through each product folder to get the image
-        for product_folder in product_folders:
-            # Get the unique ID and name of this product folder
-            folder_id = product_folder['id']
-            folder_name = product_folder['name']
-            
-            # Find the image inside this specific product folder
-            # The query looks for files that are direct children of this product folder and are images ( change the image/ to a different file type if the file type is different)
-            image_query = f"'{folder_id}' in parents and mimeType contains 'image/'"
-            
-            # Execute the query to get the image in this product folder
-            image_results = service.files().list(q=image_query, fields="files(id, name, parents)").execute()
-            
-            # Extract the list of images from the results
-            images = image_results.get('files', [])
-            count_images = len(images)
-            print("Images found in a folder:", count_images)
-            
-            # Get the image (If we need to get more than one image per painting, then change this to a for loop)
-            if images:
-                image = images[0]  # Get the single image from this folder
-                # Add the product folder name to the image data 
-                image['product_folder_name'] = folder_name
-                # Add the product folder ID to the image data
-                image['product_folder_id'] = folder_id
-                # Add to list
-                all_images.append(image)
-        
+
+        all_images = list_images_in_folders(service, product_folders, stats)
+
+        # Save and print the API call numbers for this run
+        last_listing_stats['api_calls'] = stats['api_calls']
+        last_listing_stats['product_folders'] = count_product_folders
+        last_listing_stats['images'] = len(all_images)
+        if all_images:
+            calls_per_image = stats['api_calls'] / len(all_images)
+            print("Drive API calls:", stats['api_calls'], "Calls per discovered image:", round(calls_per_image, 3))
+        else:
+            print("Drive API calls:", stats['api_calls'])
+
         return all_images
     except Exception as e:
         print("Error in list_image_files:", e)
-        return []
\ No newline at end of file
+        return []
@@ -0,0 +1,67 @@
+import os
+import json
+import hashlib
+from image_buffer import ImageBuffer
+from disk_cache import write_file_atomically, touch_file, evict_oldest_files
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Validated GPT results are saved here so a retry does not pay for a new GPT call on the same image
+LISTING_CACHE_DIR = os.getenv("LISTING_CACHE_DIR", "listing_cache")
+LISTING_CACHE_MAX_BYTES = int(os.getenv("LISTING_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Set to true to always call GPT and ignore cached results
+LISTING_CACHE_BYPASS = os.getenv("LISTING_CACHE_BYPASS", "false").lower() == "true"
+
+# SHA-256 of the image bytes, from a file path or an ImageBuffer
+def hash_image(image_source):
+    hasher = hashlib.sha256()
+    if isinstance(image_source, ImageBuffer):
+        with image_source.data.getbuffer() as view:
+            hasher.update(view)
+    else:
+        with open(image_source, 'rb') as image_file:
+            # Read in 1 MB pieces so big scans are not loaded into memory at once
+            for chunk in iter(lambda: image_file.read(1024 * 1024), b''):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+# Build the cache key from everything that changes what GPT would return
+def make_listing_cache_key(image_hash, product_info, prompt_version, model):
+    key_data = {
+        'image_hash': image_hash,
+        'product_info': product_info,
+        'prompt_version': prompt_version,
+        'model': model
+    }
+    key_text = json.dumps(key_data, sort_keys=True)
+    return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+# Returns the cached listing data for this key, or None if there is none
+def get_cached_listing(cache_key):
+    try:
+        cache_path = os.path.join(LISTING_CACHE_DIR, cache_key + ".json")
+        if not os.path.exists(cache_path):
+            return None
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            listing_data = json.load(cache_file)
+        touch_file(cache_path)
+        print("Using cached GPT listing content")
+        return listing_data
+    except Exception as e:
+        print("Error in get_cached_listing:", e)
+        return None
+
+# Save validated listing data under this key and keep the cache under its size limit
+def save_cached_listing(cache_key, listing_data):
+    try:
+        if not os.path.exists(LISTING_CACHE_DIR):
+            os.makedirs(LISTING_CACHE_DIR, exist_ok=True)
+        cache_path = os.path.join(LISTING_CACHE_DIR, cache_key + ".json")
+        write_file_atomically(cache_path, json.dumps(listing_data).encode('utf-8'))
+        evict_oldest_files(LISTING_CACHE_DIR, LISTING_CACHE_MAX_BYTES)
+        print("Saved GPT listing content to cache")
+    except Exception as e:
+        print("Error in save_cached_listing:", e)
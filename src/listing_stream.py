@@ -0,0 +1,91 @@
+import json
+
+# Reads GPT's JSON answer while it streams in and reports each top-level field (title, description, tags) as soon as
+# its value is complete, so the title and tags can be checked before the rest of the answer arrives.
+# Text before the first "{" (like a ```json fence) is skipped
+class ListingStreamParser:
+    def __init__(self):
+        self.text = ''
+        self.position = 0
+        self.started = False
+        self.finished = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.string_is_key = False
+        self.expect_key = False
+        self.current_key = None
+        self.value_start = None
+        self.fields = {}
+
+    # Add the next piece of text. Returns the names of the fields whose values were completed by it
+    def feed(self, chunk):
+        self.text = self.text + chunk
+        completed = []
+        while self.position < len(self.text) and not self.finished:
+            character = self.text[self.position]
+            if not self.started:
+                if character == '{':
+                    self.started = True
+                    self.depth = 1
+                    self.expect_key = True
+            elif self.in_string:
+                self.read_string_character(character, completed)
+            elif character == '"':
+                self.in_string = True
+                self.string_start = self.position
+                self.string_is_key = self.depth == 1 and self.expect_key
+                if self.depth == 1 and not self.string_is_key:
+                    self.value_start = self.position
+            elif character in '{[':
+                if self.depth == 1:
+                    self.value_start = self.position
+                self.depth = self.depth + 1
+            elif character in '}]':
+                self.depth = self.depth - 1
+                if self.depth == 1 and self.value_start is not None:
+                    self.complete_field(completed)
+                elif self.depth == 0:
+                    self.finished = True
+            elif character == ':' and self.depth == 1:
+                self.expect_key = False
+            elif character == ',' and self.depth == 1:
+                self.expect_key = True
+            self.position = self.position + 1
+        return completed
+
+    def read_string_character(self, character, completed):
+        if self.escaped:
+            self.escaped = False
+        elif character == '\\':
+            self.escaped = True
+        elif character == '"':
+            self.in_string = False
+            if self.string_is_key:
+                self.current_key = json.loads(self.text[self.string_start:self.position + 1])
+            elif self.depth == 1:
+                self.complete_field(completed)
+
+    # The value that started at value_start ends at the current position
+    def complete_field(self, completed):
+        try:
+            self.fields[self.current_key] = json.loads(self.text[self.value_start:self.position + 1])
+            completed.append(self.current_key)
+        except json.JSONDecodeError:
+            # Leave it to the full parse at the end to report
+            pass
+        self.value_start = None
+
+# Check one completed listing field against Etsy's limits. Returns a description of the problem, or None if it is fine
+def check_listing_field(name, value):
+    if name == 'title':
+        if not isinstance(value, str) or len(value) > 140:
+            return "title is longer than 140 characters"
+    elif name == 'tags':
+        if not isinstance(value, list) or len(value) != 13:
+            return "tags do not have exactly 13 entries"
+    elif name == 'description':
+        if not isinstance(value, str):
+            return "description is not text"
+    return None
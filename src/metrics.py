@@ -0,0 +1,237 @@
+import os
+import json
+import random
+import time
+import functools
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Timing spans are only recorded when this is true. When it is false every span is a shared do-nothing object
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+
+# One JSON line per finished span goes here
+METRICS_LOG_FILE = os.getenv("METRICS_LOG_FILE", "metrics.jsonl")
+
+# Prometheus textfile-collector snapshot of the totals
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "listing_agent.prom")
+
+# Most durations kept per (stage, outcome) for percentiles. Past this a random sample of them is kept, so a daemon that
+# runs for weeks does not grow without bound. Runs with fewer calls than this get exact percentiles
+METRICS_MAX_DURATION_SAMPLES = int(os.getenv("METRICS_MAX_DURATION_SAMPLES", "10000"))
+
+_lock = threading.Lock()
+
+# Spans that are running in the current thread, innermost last
+_thread_local = threading.local()
+
+# Totals per (stage, outcome): count, seconds, bytes, retries and a sample of the durations for percentiles
+_stage_stats = {}
+
+# Latest value of each gauge, e.g. how many GPT requests are waiting for the rate limit
+_gauges = {}
+
+# Times one pipeline stage. Use it as a context manager and add bytes, retries and an outcome label while it runs.
+# The outcome is "success" unless set, or "error" if an exception leaves the block
+class StageSpan:
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.bytes = 0
+        self.retries = 0
+        self.outcome = None
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        stack = getattr(_thread_local, 'spans', None)
+        if stack is None:
+            stack = []
+            _thread_local.spans = stack
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        _thread_local.spans.pop()
+        if self.outcome is None:
+            self.outcome = "error" if exc_type is not None else "success"
+        record_span(self.stage, self.outcome, duration, self.bytes, self.retries, self.labels)
+        return False
+
+    def add_bytes(self, count):
+        self.bytes = self.bytes + count
+
+    def add_retries(self, count):
+        self.retries = self.retries + count
+
+    def set_outcome(self, outcome):
+        self.outcome = outcome
+
+# Stand-in used when metrics are turned off. Every method does nothing
+class NoOpSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_bytes(self, count):
+        pass
+
+    def add_retries(self, count):
+        pass
+
+    def set_outcome(self, outcome):
+        pass
+
+_NO_OP_SPAN = NoOpSpan()
+
+# Start timing a stage. labels are extra fields for the JSON log, e.g. the product folder name
+def stage_span(stage, **labels):
+    if not METRICS_ENABLED:
+        return _NO_OP_SPAN
+    return StageSpan(stage, labels)
+
+# The innermost span running in this thread, so code deep inside a stage (like the Etsy retry loop) can add to it
+def current_span():
+    stack = getattr(_thread_local, 'spans', None)
+    if not stack:
+        return _NO_OP_SPAN
+    return stack[-1]
+
+# True for the values our stage functions return when they fail: None, False, or a tuple starting with None
+def is_failed_result(result):
+    if result is None or result is False:
+        return True
+    if isinstance(result, tuple) and len(result) > 0 and result[0] is None:
+        return True
+    return False
+
+# Decorator that times every call of a stage function. The outcome is "failure" when the function returns a failed
+# result, unless the function named the failure itself. So a function must only set a success label (like
+# "store_hit") once it knows the call succeeded. count_bytes(args, result) can return how many bytes the call moved
+def timed_stage(stage, count_bytes=None):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS_ENABLED:
+                return function(*args, **kwargs)
+            with StageSpan(stage, {}) as span:
+                result = function(*args, **kwargs)
+                if is_failed_result(result) and span.outcome is None:
+                    span.set_outcome("failure")
+                if count_bytes is not None and not is_failed_result(result):
+                    try:
+                        span.add_bytes(count_bytes(args, result))
+                    except Exception:
+                        pass
+                return result
+        return wrapper
+    return decorator
+
+# Add a finished span to the totals and write its JSON log line
+def record_span(stage, outcome, duration, byte_count, retries, labels):
+    entry = {
+        'time': time.time(),
+        'stage': stage,
+        'outcome': outcome,
+        'duration_seconds': round(duration, 6),
+        'bytes': byte_count,
+        'retries': retries
+    }
+    entry.update(labels)
+    with _lock:
+        stats = _stage_stats.setdefault((stage, outcome), {'count': 0, 'seconds': 0.0, 'bytes': 0, 'retries': 0, 'durations': []})
+        stats['count'] = stats['count'] + 1
+        stats['seconds'] = stats['seconds'] + duration
+        stats['bytes'] = stats['bytes'] + byte_count
+        stats['retries'] = stats['retries'] + retries
+        # Reservoir sampling: once the sample is full, every duration so far has the same chance to be in it
+        if len(stats['durations']) < METRICS_MAX_DURATION_SAMPLES:
+            stats['durations'].append(duration)
+        else:
+            index = random.randrange(stats['count'])
+            if index < METRICS_MAX_DURATION_SAMPLES:
+                stats['durations'][index] = duration
+        try:
+            with open(METRICS_LOG_FILE, 'a', encoding='utf-8') as log_file:
+                log_file.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            print("Error writing metrics log:", e)
+
+# Record one measured time that is not a whole stage, e.g. how long GPT took to send its first field
+def record_timing(stage, duration, **labels):
+    if not METRICS_ENABLED:
+        return
+    record_span(stage, "success", duration, 0, 0, labels)
+
+# Set a gauge to its current value. Gauges go into the Prometheus snapshot as they are
+def set_gauge(name, value):
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _gauges[name] = value
+
+# Duration percentile (0-100) of a stage across all outcomes, or None if the stage never ran
+def stage_percentile(stage, percentile):
+    with _lock:
+        durations = []
+        for (stats_stage, outcome), stats in _stage_stats.items():
+            if stats_stage == stage:
+                durations.extend(stats['durations'])
+    if not durations:
+        return None
+    durations.sort()
+    index = min(len(durations) - 1, int(round(percentile / 100 * (len(durations) - 1))))
+    return durations[index]
+
+# Copy of the totals, keyed by (stage, outcome)
+def get_stage_stats():
+    with _lock:
+        return {key: dict(stats, durations=list(stats['durations'])) for key, stats in _stage_stats.items()}
+
+# Forget all totals, e.g. between benchmark runs
+def reset_metrics():
+    with _lock:
+        _stage_stats.clear()
+        _gauges.clear()
+
+# Write the totals in Prometheus text format. The file is replaced in one step so the collector never reads half of it
+def write_prometheus_snapshot(path=None):
+    if not METRICS_ENABLED:
+        return
+    if path is None:
+        path = METRICS_PROM_FILE
+    try:
+        lines = [
+            "# HELP listing_agent_stage_duration_seconds Time spent in each pipeline stage.",
+            "# TYPE listing_agent_stage_duration_seconds summary"
+        ]
+        stats_items = sorted(get_stage_stats().items())
+        for (stage, outcome), stats in stats_items:
+            labels = f'stage="{stage}",outcome="{outcome}"'
+            lines.append(f"listing_agent_stage_duration_seconds_sum{{{labels}}} {stats['seconds']:.6f}")
+            lines.append(f"listing_agent_stage_duration_seconds_count{{{labels}}} {stats['count']}")
+        lines.append("# HELP listing_agent_stage_bytes_total Bytes moved by each pipeline stage.")
+        lines.append("# TYPE listing_agent_stage_bytes_total counter")
+        for (stage, outcome), stats in stats_items:
+            lines.append(f'listing_agent_stage_bytes_total{{stage="{stage}",outcome="{outcome}"}} {stats["bytes"]}')
+        lines.append("# HELP listing_agent_stage_retries_total Retries made by each pipeline stage.")
+        lines.append("# TYPE listing_agent_stage_retries_total counter")
+        for (stage, outcome), stats in stats_items:
+            lines.append(f'listing_agent_stage_retries_total{{stage="{stage}",outcome="{outcome}"}} {stats["retries"]}')
+        with _lock:
+            gauges = sorted(_gauges.items())
+        for name, value in gauges:
+            lines.append(f"# TYPE listing_agent_{name} gauge")
+            lines.append(f"listing_agent_{name} {value}")
+
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as prom_file:
+            prom_file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+    except Exception as e:
+        print("Error in write_prometheus_snapshot:", e)
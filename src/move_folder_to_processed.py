@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 import os
+from metrics import timed_stage
 
 # Load environment variables from env file
 load_dotenv('config.env')
@@ -7,22 +8,31 @@ load_dotenv('config.env')
 # Folder ID for destination (processed folder)
 PROCESSED_FOLDER_ID = os.getenv("PROCESSED_FOLDER_ID")
 
-def move_product_folder_to_processed(service, product_folder_id):
+# Drive accepts at most 100 calls in one batch request
+DRIVE_BATCH_SIZE = 100
+
+@timed_stage('drive_move')
+def move_product_folder_to_processed(service, product_folder_id, previous_parent=None):
     """
     Move an entire product folder from Unprocessed to Processed.
+    Pass previous_parent when the folder's parent is already known to skip looking it up.
+    Returns True if the move worked.
     """
     try:
         print("Moving product folder to Processed")
-        
-        # Get the current parents of the product folder
-        folder = service.files().get(fileId=product_folder_id, fields='parents').execute()
-        
-        # Get the parents list
-        parents_list = folder.get('parents')
-        
-        # Get the single parent
-        previous_parents = parents_list[0]
-        
+
+        if previous_parent is None:
+            # Get the current parents of the product folder
+            folder = service.files().get(fileId=product_folder_id, fields='parents').execute()
+
+            # Get the parents list
+            parents_list = folder.get('parents')
+
+            # Get the single parent
+            previous_parents = parents_list[0]
+        else:
+            previous_parents = previous_parent
+
         # Move the entire product folder to the processed folder
         service.files().update(
             fileId=product_folder_id,
@@ -31,5 +41,69 @@ def move_product_folder_to_processed(service, product_folder_id):
             fields='id, parents'
         ).execute()
         print("Folder moved to Processed")
+        return True
     except Exception as e:
         print("Error in move_product_folder_to_processed:", e)
+        return False
+
+# Send many Drive calls in batch requests of up to DRIVE_BATCH_SIZE calls each.
+# requests is a dict of ID -> request. Returns ID -> (response, exception), one of which is None
+def execute_in_batches(service, requests):
+    responses = {}
+
+    def callback(request_id, response, exception):
+        responses[request_id] = (response, exception)
+
+    request_ids = list(requests.keys())
+    for start in range(0, len(request_ids), DRIVE_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id in request_ids[start:start + DRIVE_BATCH_SIZE]:
+            batch.add(requests[request_id], request_id=request_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            print("Drive batch request failed:", e)
+        # Anything the batch did not answer counts as failed
+        for request_id in request_ids[start:start + DRIVE_BATCH_SIZE]:
+            if request_id not in responses:
+                responses[request_id] = (None, Exception("no response in Drive batch"))
+    return responses
+
+@timed_stage('drive_bulk_move')
+def move_product_folders_to_processed(service, product_folders):
+    """
+    Move many product folders to Processed with Drive batch requests.
+    product_folders is a dict of product folder ID -> its current parent ID, or None if the parent is unknown.
+    Folders with an unknown parent are looked up first, also in batches.
+    Returns a dict of product folder ID -> True if that folder was moved.
+    """
+    print("Moving product folders to Processed:", len(product_folders))
+    parents = dict(product_folders)
+    results = {}
+
+    unknown = [folder_id for folder_id, parent in parents.items() if parent is None]
+    if unknown:
+        lookups = {folder_id: service.files().get(fileId=folder_id, fields='parents') for folder_id in unknown}
+        for folder_id, (response, exception) in execute_in_batches(service, lookups).items():
+            if exception is not None or not response.get('parents'):
+                print("Could not look up the parent of a product folder:", exception)
+                results[folder_id] = False
+                del parents[folder_id]
+            else:
+                parents[folder_id] = response['parents'][0]
+
+    updates = {}
+    for folder_id, parent in parents.items():
+        updates[folder_id] = service.files().update(
+            fileId=folder_id,
+            addParents=PROCESSED_FOLDER_ID,
+            removeParents=parent,
+            fields='id, parents'
+        )
+    for folder_id, (response, exception) in execute_in_batches(service, updates).items():
+        if exception is not None:
+            print("Error moving a product folder:", exception)
+        results[folder_id] = exception is None
+
+    print("Folders moved to Processed:", len([moved for moved in results.values() if moved]), "of", len(results))
+    return results
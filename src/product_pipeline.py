@@ -0,0 +1,340 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from download_file import download_file, download_file_to_buffer, download_file_to_store, download_thumbnail, cleanup_etsy_images_files
+from image_store import IMAGE_STORE_ENABLED
+from drive_authentication import get_shared_drive_service
+from image_buffer import ImageBuffer, get_thread_image_buffer
+from image_preprocessor import gpt_rendition_max_dimension
+from move_folder_to_processed import move_product_folder_to_processed, move_product_folders_to_processed
+from gpt_processor import generate_etsy_listing_content, extract_product_info, listing_cache_key, variant_image_hash, find_variant_listing
+from gpt_batch import BatchFileWriter, make_batch_line, submit_batch_files
+from listing_cache import LISTING_CACHE_BYPASS, get_cached_listing, save_cached_listing
+from publishers import PUBLISH_WORKERS, PublishContext, get_publishers, prepare_everywhere, publish_everywhere
+from variant_index import save_listing_hash
+from job_journal import get_job, stage_reached, record_stage, record_error, get_unfinished_batches
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Keep downloaded images in memory and hand the same bytes to GPT and Etsy instead of writing them to disk
+USE_MEMORY_BUFFER = os.getenv("USE_MEMORY_BUFFER", "false").lower() == "true"
+
+# Give GPT a sized Drive thumbnail and only download the full original for the Etsy upload
+GPT_USE_THUMBNAILS = os.getenv("GPT_USE_THUMBNAILS", "false").lower() == "true"
+GPT_THUMBNAIL_SIZE = int(os.getenv("GPT_THUMBNAIL_SIZE", "1536"))
+
+# Upload the images to the marketplaces while GPT is still writing the listing, instead of after it.
+# A product then takes about as long as the slower of the two instead of both added up
+OVERLAP_PUBLISH_WITH_GPT = os.getenv("OVERLAP_PUBLISH_WITH_GPT", "true").lower() == "true"
+
+# How many images of multi-image products are downloaded at the same time, across all products
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv("IMAGE_DOWNLOAD_WORKERS", "4"))
+
+# Shared by all products so its threads live for the whole run
+_download_executor = ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS)
+
+# Runs the marketplace preparation that overlaps GPT. Kept apart from the download pool,
+# which the preparation itself waits on
+_prepare_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS)
+
+# Build the result we report for one product folder
+def make_result(image_file, success, error=None):
+    result = {
+        'product_folder_id': image_file.get('product_folder_id'),
+        'product_folder_name': image_file.get('product_folder_name'),
+        'success': success,
+        'error': error
+    }
+    return result
+
+# Record the failure in the journal and build the failed result
+def fail(image_file, error):
+    print("Product folder failed:", error)
+    record_error(image_file['product_folder_id'], error)
+    return make_result(image_file, False, error)
+
+# Download one full original to disk or into memory.
+# Returns the image (a path or an ImageBuffer) and the folder name to clean up afterwards.
+# Images with a Drive checksum go through the image store, which keeps them, so there is nothing to clean up
+def download_one_image(service, image, product_folder_name, image_buffer=None):
+    md5_checksum = image.get('md5Checksum')
+    if USE_MEMORY_BUFFER:
+        if image_buffer is None:
+            image_buffer = ImageBuffer()
+        download_path = download_file_to_buffer(service, image['id'], image['name'], image_buffer, md5_checksum)
+        if download_path is not None:
+            print("Estimated peak memory for this image in bytes:", download_path.estimated_peak_memory(gpt_rendition_max_dimension()))
+        return download_path, None
+    if IMAGE_STORE_ENABLED and md5_checksum is not None:
+        return download_file_to_store(service, image['id'], image['name'], md5_checksum, image.get('size')), None
+    return download_file(service, image['id'], image['name'], product_folder_name)
+
+# Download the full originals of the given images, several at once, and record the stage.
+# Returns a dict of Drive file ID -> downloaded image and the folder name to clean up, or None if any download failed.
+# Pass use_thread_buffer=False when the calling thread's memory buffer may be busy with another product
+def download_images(service, image_file, images, use_thread_buffer=True):
+    product_folder_name = image_file['product_folder_name']
+    if len(images) == 1:
+        # A single image uses this worker's Drive service and its reusable memory buffer
+        image_buffer = get_thread_image_buffer() if USE_MEMORY_BUFFER and use_thread_buffer else None
+        results = [download_one_image(service, images[0], product_folder_name, image_buffer)]
+    else:
+        # The shared Drive service gives every download thread its own pooled connection
+        results = list(_download_executor.map(
+            lambda image: download_one_image(get_shared_drive_service(), image, product_folder_name), images))
+
+    downloads = {}
+    safe_folder_name = None
+    for image, (download_path, folder_name) in zip(images, results):
+        if folder_name is not None:
+            safe_folder_name = folder_name
+        downloads[image['id']] = download_path
+    if None in downloads.values():
+        return None, safe_folder_name
+
+    print("Images downloaded locally:", len(downloads))
+    record_stage(image_file['product_folder_id'], product_folder_name, 'downloaded')
+    return downloads, safe_folder_name
+
+# Get the image GPT should look at: a Drive thumbnail when thumbnails are turned on and worth it, otherwise None
+def get_gpt_thumbnail(service, image_file):
+    if not GPT_USE_THUMBNAILS:
+        return None
+    # If the original is already about thumbnail size, the thumbnail saves nothing
+    metadata = image_file.get('imageMediaMetadata', {})
+    longest_side = max(metadata.get('width', 0), metadata.get('height', 0))
+    if longest_side and longest_side <= GPT_THUMBNAIL_SIZE:
+        return None
+    return download_thumbnail(service, image_file, GPT_THUMBNAIL_SIZE)
+
+# Runs in the background while GPT writes the listing: download the originals the marketplaces need that are not
+# downloaded yet, then let each marketplace do the work that does not need the listing content, like the Etsy upload.
+# Returns the folder name to clean up afterwards
+def prepare_publishers(image_file, publishers, context):
+    missing = [image for image in images_for_publishers(publishers, context.job, context.images) if image['id'] not in context.downloads]
+    safe_folder_name = None
+    if missing:
+        # This is not the product's worker thread, so it must not use the worker's image buffer
+        new_downloads, safe_folder_name = download_images(get_shared_drive_service(), image_file, missing, use_thread_buffer=False)
+        if new_downloads is None:
+            print("Background download failed. The images are downloaded again before publishing")
+            return safe_folder_name
+        context.downloads.update(new_downloads)
+    prepare_everywhere(publishers, context)
+    return safe_folder_name
+
+# The images any of the given publishers still needs, in rank order and without duplicates
+def images_for_publishers(publishers, job, images):
+    needed_ids = set()
+    for publisher in publishers:
+        needed_ids.update(image['id'] for image in publisher.images_needed(job, images))
+    return [image for image in images if image['id'] in needed_ids]
+
+# Run one product folder through download -> GPT -> every marketplace -> move.
+# Every finished stage is saved in the job journal, so a later run skips it and resumes at the stage that failed.
+# With defer_move the Drive move is left out and the result gets move_pending, so move_finished_products can
+# move many folders together
+def process_product(service, image_file, defer_move=False):
+    product_folder_id = image_file.get('product_folder_id')
+    product_folder_name = image_file.get('product_folder_name')
+    if product_folder_id is None or product_folder_name is None:
+        print("Missing product folder information")
+        return make_result(image_file, False, "missing product folder information")
+
+    print("Processing product folder:", product_folder_name)
+    job = get_job(product_folder_id)
+    if job is None:
+        record_stage(product_folder_id, product_folder_name, 'discovered')
+        job = get_job(product_folder_id)
+    elif stage_reached(job, 'moved'):
+        print("Product folder was already finished in an earlier run")
+        return make_result(image_file, True)
+    elif job['stage'] != 'discovered':
+        print("Resuming product folder after stage:", job['stage'])
+
+    publishers = get_publishers()
+    if not publishers:
+        print("No marketplace in MARKETPLACES is configured")
+        return make_result(image_file, False, "no marketplace is configured")
+    # Marketplaces that finished in an earlier run are not published to again
+    publishers = [publisher for publisher in publishers if not publisher.published(job)]
+
+    # Every image in the folder in rank order. The first one is the main image GPT looks at
+    images = image_file.get('product_images') or [image_file]
+    main_image = images[0]
+
+    # Full originals are only downloaded when a stage needs them, and at most once
+    downloads = {}
+    safe_folder_name = None
+    try:
+        if stage_reached(job, 'generated'):
+            listing_data, product_info = job['listing_data'], job['product_info']
+        else:
+            gpt_image = get_gpt_thumbnail(service, main_image)
+            if gpt_image is None:
+                if OVERLAP_PUBLISH_WITH_GPT:
+                    # GPT only needs the main image. The rest is downloaded in the background while GPT runs
+                    needed = [main_image]
+                else:
+                    # Download everything the marketplaces will also need now, so all downloads run together
+                    needed = [main_image] + [image for image in images_for_publishers(publishers, job, images) if image['id'] != main_image['id']]
+                downloads, safe_folder_name = download_images(service, image_file, needed)
+                if downloads is None:
+                    return fail(image_file, "download failed")
+                gpt_image = downloads[main_image['id']]
+
+            prepare_future = None
+            if OVERLAP_PUBLISH_WITH_GPT and publishers:
+                context = PublishContext(image_file, images, job, None, None, downloads)
+                prepare_future = _prepare_executor.submit(prepare_publishers, image_file, publishers, context)
+            try:
+                listing_data, product_info = generate_etsy_listing_content(gpt_image, product_folder_name)
+            finally:
+                # Wait for the background work even if GPT failed, so its downloads are cleaned up and its uploads
+                # are in the journal for the next run to reuse
+                if prepare_future is not None:
+                    folder_name = prepare_future.result()
+                    if folder_name is not None:
+                        safe_folder_name = folder_name
+            if listing_data is None or product_info is None:
+                return fail(image_file, "GPT generation failed")
+            print("Received listing content from GPT")
+            record_stage(product_folder_id, product_folder_name, 'generated', listing_data=listing_data, product_info=product_info)
+
+        if publishers:
+            missing = [image for image in images_for_publishers(publishers, job, images) if image['id'] not in downloads]
+            if missing:
+                # The main image may already sit in this thread's buffer, so these must not reuse it
+                new_downloads, folder_name = download_images(service, image_file, missing, use_thread_buffer=False)
+                if folder_name is not None:
+                    safe_folder_name = folder_name
+                if new_downloads is None:
+                    return fail(image_file, "download failed")
+                downloads.update(new_downloads)
+
+            # The same listing content goes to every marketplace at once. A marketplace that fails keeps the product
+            # in Unprocessed, and the next run only publishes to the ones that did not finish
+            context = PublishContext(image_file, images, job, listing_data, product_info, downloads)
+            errors = publish_everywhere(publishers, context)
+            failed = [f"{name}: {error}" for name, error in errors.items() if error is not None]
+            if failed:
+                return fail(image_file, "; ".join(failed))
+
+        if not stage_reached(job, 'moved'):
+            if defer_move:
+                result = make_result(image_file, True)
+                result['move_pending'] = True
+                return result
+            if not move_product_folder_to_processed(service, product_folder_id, image_file.get('product_folder_parent_id')):
+                return fail(image_file, "Drive move failed")
+            print("Moved product folder to Processed")
+            record_stage(product_folder_id, product_folder_name, 'moved')
+        return make_result(image_file, True)
+    finally:
+        if safe_folder_name is not None:
+            cleanup_etsy_images_files(safe_folder_name)
+            print("Cleaned up local downloaded images")
+
+# Move the folders of every result with move_pending to Processed with Drive batch requests and record the stage.
+# A folder that could not be moved turns its result into a failure
+def move_finished_products(service, image_files, results):
+    pending = [result for result in results if result.get('move_pending')]
+    if not pending:
+        return
+    parents = {}
+    for image_file in image_files:
+        parents[image_file['product_folder_id']] = image_file.get('product_folder_parent_id')
+    moved = move_product_folders_to_processed(service, {result['product_folder_id']: parents.get(result['product_folder_id']) for result in pending})
+    for result in pending:
+        del result['move_pending']
+        if moved.get(result['product_folder_id']):
+            record_stage(result['product_folder_id'], result['product_folder_name'], 'moved')
+        else:
+            record_error(result['product_folder_id'], "Drive move failed")
+            result['success'] = False
+            result['error'] = "Drive move failed"
+
+# Bulk generation step 1: prepare one product for the Batch API. Products with a cached listing, or a variant
+# listing to reuse, are recorded as generated right away, the rest get a request line in the batch file.
+# Products in in_flight are already in a batch an earlier run started, so they are not queued again.
+# Returns the cache key and variant image hash of a queued product, otherwise (None, None)
+def queue_batch_generation(image_file, batch_writer, in_flight=()):
+    product_folder_id = image_file['product_folder_id']
+    product_folder_name = image_file['product_folder_name']
+    job = get_job(product_folder_id)
+    if job is None:
+        record_stage(product_folder_id, product_folder_name, 'discovered')
+    elif stage_reached(job, 'generated'):
+        return None, None
+
+    service = get_shared_drive_service()
+    main_image = (image_file.get('product_images') or [image_file])[0]
+    safe_folder_name = None
+    try:
+        gpt_image = get_gpt_thumbnail(service, main_image)
+        if gpt_image is None:
+            downloads, safe_folder_name = download_images(service, image_file, [main_image])
+            if downloads is None:
+                record_error(product_folder_id, "download failed")
+                return None, None
+            gpt_image = downloads[main_image['id']]
+
+        product_info = extract_product_info(product_folder_name)
+        cache_key = listing_cache_key(gpt_image, product_info)
+        listing_data = None if LISTING_CACHE_BYPASS else get_cached_listing(cache_key)
+        image_hash = variant_image_hash(gpt_image)
+        if listing_data is None and image_hash is not None:
+            listing_data = find_variant_listing(image_hash, product_info)
+        if listing_data is not None:
+            record_stage(product_folder_id, product_folder_name, 'generated', listing_data=listing_data, product_info=product_info)
+            return None, None
+
+        if product_folder_id in in_flight:
+            return cache_key, image_hash
+        line = make_batch_line(product_folder_id, gpt_image, product_info)
+        if line is None:
+            record_error(product_folder_id, "could not prepare image for GPT")
+            return None, None
+        batch_writer.add(product_folder_id, line)
+        return cache_key, image_hash
+    finally:
+        if safe_folder_name is not None:
+            cleanup_etsy_images_files(safe_folder_name)
+
+# Bulk generation for many products with the OpenAI Batch API instead of one GPT call each.
+# Validated results are saved in the journal as the generated stage, so process_product goes straight to Etsy.
+# Returns the image files whose listing content is ready
+def generate_listings_with_batch(image_files, executor):
+    # Products an earlier run already sent in a batch that it never finished waiting for get their results from that batch
+    in_flight = set()
+    try:
+        for custom_ids in get_unfinished_batches().values():
+            in_flight.update(custom_ids)
+    except Exception as e:
+        print("Error reading unfinished GPT batches:", e)
+    batch_writer = BatchFileWriter()
+    queued = list(executor.map(lambda image_file: queue_batch_generation(image_file, batch_writer, in_flight), image_files))
+    batch_paths = batch_writer.close()
+    print("Products queued for the GPT batch:", batch_writer.line_count)
+
+    listings = {}
+    if batch_paths or in_flight:
+        listings = submit_batch_files(batch_paths, batch_writer.custom_ids)
+        print("Listings returned by the GPT batch:", len(listings))
+
+    ready = []
+    for image_file, (cache_key, image_hash) in zip(image_files, queued):
+        product_folder_id = image_file['product_folder_id']
+        listing_data = listings.get(product_folder_id)
+        if listing_data is not None:
+            product_info = extract_product_info(image_file['product_folder_name'])
+            record_stage(product_folder_id, image_file['product_folder_name'], 'generated', listing_data=listing_data, product_info=product_info)
+            save_cached_listing(cache_key, listing_data)
+            if image_hash is not None:
+                save_listing_hash(image_hash, product_info, listing_data)
+        elif cache_key is not None:
+            record_error(product_folder_id, "GPT batch generation failed")
+        if stage_reached(get_job(product_folder_id), 'generated'):
+            ready.append(image_file)
+    return ready
@@ -0,0 +1,207 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from etsy_processor import etsy_configured, upload_images_to_etsy, create_draft_listing, add_images_to_listing
+from job_journal import stage_reached, record_stage, record_published
+from metrics import stage_span
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Comma separated marketplaces every product is published to. All of them get the same GPT listing content
+MARKETPLACES = os.getenv("MARKETPLACES", "etsy")
+
+# How many publishes run at the same time, across all products and marketplaces
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", "8"))
+
+# Shared by all products. Publishers do not submit work to it themselves, so a product waiting on it can not block it
+_publish_executor = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS)
+
+# Everything a publisher needs for one product: the listing content and the downloaded images, keyed by Drive file ID.
+# job is the journal entry read when the product started. listing_data and product_info are None during prepare()
+class PublishContext:
+    def __init__(self, image_file, images, job, listing_data, product_info, downloads):
+        self.image_file = image_file
+        self.images = images
+        self.job = job
+        self.listing_data = listing_data
+        self.product_info = product_info
+        self.downloads = downloads
+
+# A marketplace that listings are published to. Each publisher talks to its marketplace through its own client and
+# rate limiter, and saves its own progress, so a retry only repeats the steps that did not finish.
+# run_publisher records in the journal when a marketplace finished, so a retry never publishes to it twice
+class Publisher:
+    name = None
+
+    # True if the settings this marketplace needs are there
+    def configured(self):
+        return True
+
+    # True if an earlier run already finished publishing this product
+    def published(self, job):
+        return job is not None and self.name in job['published']
+
+    # The images whose full originals publish() will read from context.downloads
+    def images_needed(self, job, images):
+        return list(images)
+
+    # Work that does not need the listing content, like uploading images. It runs while GPT is still writing the
+    # listing, so the upload and the GPT call overlap. Returns None if it worked, otherwise what failed.
+    # publish() is called afterwards either way and finishes whatever prepare() could not
+    def prepare(self, context):
+        return None
+
+    # Publish one product. Returns None if it worked, otherwise a short description of what failed
+    def publish(self, context):
+        raise NotImplementedError
+
+# Etsy draft listings. Progress is kept in the job journal's image_ids, listing_id and Etsy stages.
+# A new instance is made for every product, so it can keep the image IDs prepare() uploaded for publish()
+class EtsyPublisher(Publisher):
+    name = 'etsy'
+
+    def __init__(self):
+        self.image_ids = None
+
+    def configured(self):
+        return etsy_configured()
+
+    # Older journals only have the Etsy stages
+    def published(self, job):
+        return super().published(job) or stage_reached(job, 'image_associated')
+
+    # Etsy image IDs of images uploaded in earlier runs, keyed by Drive file ID
+    def uploaded_image_ids(self, job, images):
+        image_ids = dict(job['image_ids'])
+        if not image_ids and job['image_id'] is not None:
+            # Journals from before multi-image products only saved the main image's ID
+            image_ids[images[0]['id']] = job['image_id']
+        return image_ids
+
+    def images_needed(self, job, images):
+        if stage_reached(job, 'image_uploaded'):
+            return []
+        image_ids = self.uploaded_image_ids(job, images)
+        return [image for image in images if image['id'] not in image_ids]
+
+    # Upload the images that do not have an Etsy image ID yet. The IDs are saved in the journal as they arrive,
+    # without moving the stage, so uploads made before GPT finished are reused by the next run if GPT fails
+    def upload_pending(self, context):
+        product_folder_id = context.image_file['product_folder_id']
+        product_folder_name = context.image_file['product_folder_name']
+        if self.image_ids is None:
+            self.image_ids = self.uploaded_image_ids(context.job, context.images)
+        pending = [image for image in context.images if image['id'] not in self.image_ids]
+        if not pending:
+            return None
+        uploaded_ids = upload_images_to_etsy([context.downloads[image['id']] for image in pending])
+        new_image_ids = {}
+        for image, image_id in zip(pending, uploaded_ids):
+            if image_id is not None:
+                new_image_ids[image['id']] = image_id
+        self.image_ids.update(new_image_ids)
+        if new_image_ids:
+            record_stage(product_folder_id, product_folder_name, 'discovered', image_id=self.image_ids.get(context.images[0]['id']), image_ids=new_image_ids)
+        if len(new_image_ids) != len(pending):
+            return "Etsy image upload failed"
+        return None
+
+    def prepare(self, context):
+        if stage_reached(context.job, 'image_uploaded'):
+            return None
+        return self.upload_pending(context)
+
+    def publish(self, context):
+        job, images = context.job, context.images
+        main_image = images[0]
+        product_folder_id = context.image_file['product_folder_id']
+        product_folder_name = context.image_file['product_folder_name']
+        if self.image_ids is None:
+            self.image_ids = self.uploaded_image_ids(job, images)
+        image_ids = self.image_ids
+
+        if not stage_reached(job, 'image_uploaded'):
+            # Only what prepare() did not manage is uploaded here
+            error = self.upload_pending(context)
+            if error is not None:
+                return error
+            record_stage(product_folder_id, product_folder_name, 'image_uploaded', image_id=image_ids.get(main_image['id']))
+
+        if stage_reached(job, 'listing_created'):
+            listing_id = job['listing_id']
+        else:
+            listing_id = create_draft_listing(context.listing_data, image_ids[main_image['id']], context.product_info, associate_image=False)
+            if listing_id is None:
+                return "Etsy draft listing failed"
+            print("Created Etsy draft listing")
+            record_stage(product_folder_id, product_folder_name, 'listing_created', listing_id=listing_id)
+
+        ranked_image_ids = [image_ids[image['id']] for image in images if image['id'] in image_ids]
+        if not add_images_to_listing(listing_id, ranked_image_ids):
+            return "Etsy image association failed"
+        print("Associated uploaded images with the listing:", len(ranked_image_ids))
+        record_stage(product_folder_id, product_folder_name, 'image_associated')
+        return None
+
+# Every marketplace we know how to publish to. A new marketplace is one Publisher class added here
+PUBLISHER_CLASSES = {
+    'etsy': EtsyPublisher
+}
+
+# The configured publishers from MARKETPLACES. Unknown names and marketplaces with missing settings are left out
+def get_publishers():
+    publishers = []
+    for name in MARKETPLACES.split(','):
+        name = name.strip().lower()
+        if not name:
+            continue
+        publisher_class = PUBLISHER_CLASSES.get(name)
+        if publisher_class is None:
+            print("Unknown marketplace in MARKETPLACES:", name)
+            continue
+        publisher = publisher_class()
+        if not publisher.configured():
+            print("Marketplace is not configured:", name)
+            continue
+        publishers.append(publisher)
+    return publishers
+
+# Run one publisher and turn any exception into a failure, so one marketplace can never break the others
+def run_publisher(publisher, context):
+    with stage_span('publish', marketplace=publisher.name) as span:
+        try:
+            error = publisher.publish(context)
+        except Exception as e:
+            print("Error publishing to", publisher.name + ":", e)
+            error = str(e)
+        if error is None:
+            try:
+                record_published(context.image_file['product_folder_id'], publisher.name)
+            except Exception as e:
+                print("Error recording publish to", publisher.name + ":", e)
+        else:
+            span.set_outcome("failure")
+        return error
+
+# Run prepare() of every publisher, one after the other. This already runs in the background next to GPT.
+# A failure is only printed, because publish() tries again
+def prepare_everywhere(publishers, context):
+    for publisher in publishers:
+        with stage_span('publish_prepare', marketplace=publisher.name) as span:
+            try:
+                error = publisher.prepare(context)
+            except Exception as e:
+                error = str(e)
+            if error is not None:
+                print("Preparing", publisher.name, "failed, trying again when publishing:", error)
+                span.set_outcome("failure")
+
+# Publish one product to every given marketplace at the same time.
+# Returns a dict of marketplace name -> None if it worked or what failed
+def publish_everywhere(publishers, context):
+    if len(publishers) == 1:
+        # Nothing to overlap, so skip the thread hop
+        return {publishers[0].name: run_publisher(publishers[0], context)}
+    futures = {publisher.name: _publish_executor.submit(run_publisher, publisher, context) for publisher in publishers}
+    return {name: future.result() for name, future in futures.items()}
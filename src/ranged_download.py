@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from drive_authentication import get_shared_drive_service
+from metrics import current_span, record_timing
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Files at least this big are fetched as several byte ranges at the same time instead of one stream
+RANGED_DOWNLOAD_MIN_BYTES = int(os.getenv("RANGED_DOWNLOAD_MIN_BYTES", str(32 * 1024 * 1024)))
+RANGED_DOWNLOAD_CHUNK_BYTES = int(os.getenv("RANGED_DOWNLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+RANGED_DOWNLOAD_WORKERS = int(os.getenv("RANGED_DOWNLOAD_WORKERS", "4"))
+
+# How many times one range is tried before the download stops. Finished ranges are kept for the next attempt
+RANGED_DOWNLOAD_RETRIES = int(os.getenv("RANGED_DOWNLOAD_RETRIES", "3"))
+
+# Shared by all downloads so the number of open range requests stays bounded however many files download at once.
+# Every range request runs on its own pooled connection of the shared Drive service
+_range_executor = ThreadPoolExecutor(max_workers=RANGED_DOWNLOAD_WORKERS)
+
+# Only one thread at a time may work on the partial file of a given download. The caller holds the same lock around
+# its store check and storing the finished file, so it is reentrant
+_partial_locks = {}
+_partial_locks_lock = threading.Lock()
+
+def get_partial_lock(partial_path):
+    with _partial_locks_lock:
+        return _partial_locks.setdefault(partial_path, threading.RLock())
+
+# Which ranges of a partial download are finished. Saved next to the partial file after every range, so an
+# interrupted download picks up where it stopped
+class DownloadProgress:
+    def __init__(self, progress_path, file_size, chunk_size):
+        self.progress_path = progress_path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(progress_path):
+            try:
+                with open(progress_path, 'r', encoding='utf-8') as progress_file:
+                    saved = json.load(progress_file)
+                # Progress from a different size or chunk layout can not be trusted
+                if saved.get('file_size') == file_size and saved.get('chunk_size') == chunk_size:
+                    self.done = set(saved.get('done', []))
+            except Exception as e:
+                print("Ignoring unreadable download progress:", e)
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+
+    def mark_done(self, index):
+        with self.lock:
+            self.done.add(index)
+            temp_path = self.progress_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as progress_file:
+                json.dump({'file_size': self.file_size, 'chunk_size': self.chunk_size, 'done': sorted(self.done)}, progress_file)
+            os.replace(temp_path, self.progress_path)
+
+# Fetch one byte range and write it at its place in the partial file. Tries again with backoff on errors.
+# The range is saved as done in progress as soon as it is written, whatever order the ranges finish in,
+# so an interruption only loses the ranges that were still running
+def download_range(file_id, partial_path, start, end, progress, index):
+    attempt = 0
+    while True:
+        try:
+            request = get_shared_drive_service().files().get_media(fileId=file_id)
+            headers = dict(getattr(request, 'headers', {}) or {})
+            headers['range'] = f"bytes={start}-{end}"
+            response, content = request.http.request(request.uri, 'GET', headers=headers)
+            if response.status not in (200, 206):
+                raise Exception(f"range request failed with status {response.status}")
+            if response.status == 200:
+                # The server ignored the range and sent the whole file, so take our part of it
+                content = content[start:end + 1]
+            if len(content) != end - start + 1:
+                raise Exception(f"range request returned {len(content)} bytes instead of {end - start + 1}")
+            with open(partial_path, 'r+b') as partial_file:
+                partial_file.seek(start)
+                partial_file.write(content)
+            progress.mark_done(index)
+            return len(content)
+        except Exception as e:
+            attempt = attempt + 1
+            if attempt >= RANGED_DOWNLOAD_RETRIES:
+                raise
+            delay = min(10.0, (2 ** attempt) * 0.5) * random.uniform(0.5, 1.5)
+            print("Range download failed, retrying in", round(delay, 1), "seconds:", e)
+            current_span().add_retries(1)
+            time.sleep(delay)
+
+# MD5 of a file, read in 1 MB pieces
+def file_md5(path):
+    hasher = hashlib.md5()
+    with open(path, 'rb') as check_file:
+        for chunk in iter(lambda: check_file.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# Download a large Drive file into partial_path with several range requests at once. Ranges finished by an earlier,
+# interrupted attempt are not fetched again. Returns the MD5 of the finished file, or None if a range failed.
+# The partial file and its progress are kept after a failure so the next call resumes
+def download_file_in_ranges(file_id, file_name, file_size, partial_path, chunk_size=RANGED_DOWNLOAD_CHUNK_BYTES):
+    progress_path = partial_path + ".progress"
+    with get_partial_lock(partial_path):
+        progress = DownloadProgress(progress_path, file_size, chunk_size)
+        if not os.path.exists(partial_path) or os.path.getsize(partial_path) != file_size:
+            # Start over with a file of the final size that each range can be written into
+            progress.done = set()
+            with open(partial_path, 'wb') as partial_file:
+                partial_file.truncate(file_size)
+
+        ranges = []
+        for index, start in enumerate(range(0, file_size, chunk_size)):
+            if index not in progress.done:
+                ranges.append((index, start, min(start + chunk_size, file_size) - 1))
+        if len(ranges) < (file_size + chunk_size - 1) // chunk_size:
+            print("Resuming download of", file_name, "- ranges left:", len(ranges))
+
+        start_time = time.perf_counter()
+        futures = []
+        for index, start, end in ranges:
+            futures.append(_range_executor.submit(download_range, file_id, partial_path, start, end, progress, index))
+        downloaded_bytes = 0
+        failed = False
+        for future in futures:
+            try:
+                downloaded_bytes = downloaded_bytes + future.result()
+            except Exception as e:
+                print("Range download gave up:", e)
+                failed = True
+        elapsed = time.perf_counter() - start_time
+
+        current_span().add_bytes(downloaded_bytes)
+        megabytes_per_second = downloaded_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+        print("Downloaded", round(downloaded_bytes / (1024 * 1024), 1), "MB of", file_name, "in", round(elapsed, 2),
+              "seconds:", round(megabytes_per_second, 1), "MB/s")
+        record_timing('drive_ranged_download', elapsed, file_name=file_name, bytes=downloaded_bytes,
+                      megabytes_per_second=round(megabytes_per_second, 3))
+        if failed:
+            return None
+
+        os.remove(progress_path)
+        return file_md5(partial_path)
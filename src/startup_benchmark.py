@@ -0,0 +1,92 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Measures how long a cron run of drive_watcher.py takes when there is nothing new in Drive. Every sample is a fresh
+# Python process, because import and discovery costs only show up on a cold start.
+# The child imports drive_watcher, builds a real Drive service from the discovery document, and runs one
+# watcher pass against an empty fake Drive. It reports which heavy modules got imported along the way
+
+# Modules an empty run should never need
+HEAVY_MODULES = ['openai', 'requests', 'PIL', 'product_pipeline', 'gpt_processor', 'etsy_processor']
+
+# One measured run inside a fresh process. Prints a JSON line with the timings
+def run_child():
+    start_time = time.perf_counter()
+    import drive_watcher
+    from drive_authentication import build_drive_service, set_drive_service_factory
+    from fake_drive_service import FakeDriveService
+    from google.auth.credentials import AnonymousCredentials
+    import_seconds = time.perf_counter() - start_time
+
+    build_start = time.perf_counter()
+    build_drive_service(AnonymousCredentials())
+    build_seconds = time.perf_counter() - build_start
+
+    # The watcher pass itself runs against an empty fake Drive so no credentials or network are needed
+    drive = FakeDriveService()
+    set_drive_service_factory(lambda: drive)
+    watch_start = time.perf_counter()
+    drive_watcher.drive_watcher()
+    watch_seconds = time.perf_counter() - watch_start
+
+    result = {
+        'import_seconds': import_seconds,
+        'build_seconds': build_seconds,
+        'watch_seconds': watch_seconds,
+        'heavy_modules': [name for name in HEAVY_MODULES if name in sys.modules]
+    }
+    print("STARTUP_RESULT " + json.dumps(result))
+
+# Run the child in a new interpreter and return its timings plus the wall time of the whole process
+def run_sample():
+    start_time = time.perf_counter()
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'],
+                               capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    wall_seconds = time.perf_counter() - start_time
+    for line in completed.stdout.splitlines():
+        if line.startswith("STARTUP_RESULT "):
+            result = json.loads(line[len("STARTUP_RESULT "):])
+            result['wall_seconds'] = wall_seconds
+            return result
+    raise Exception("Startup child failed:\n" + completed.stdout + completed.stderr)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup cost of a drive_watcher run that finds nothing to do")
+    parser.add_argument("--runs", type=int, default=5, help="how many fresh processes to time")
+    parser.add_argument("--max-seconds", type=float, help="fail if the median wall time is above this")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return
+
+    samples = [run_sample() for _ in range(max(1, args.runs))]
+    print(f"{'':<16}{'median ms':>12}{'max ms':>10}")
+    for key in ('import_seconds', 'build_seconds', 'watch_seconds', 'wall_seconds'):
+        values = [sample[key] for sample in samples]
+        print(f"{key.replace('_seconds', ''):<16}{median(values) * 1000:>12.1f}{max(values) * 1000:>10.1f}")
+
+    heavy_modules = sorted(set(name for sample in samples for name in sample['heavy_modules']))
+    failed = False
+    if heavy_modules:
+        print("Heavy modules imported by an empty run:", ", ".join(heavy_modules))
+        failed = True
+    wall_median = median([sample['wall_seconds'] for sample in samples])
+    if args.max_seconds is not None and wall_median > args.max_seconds:
+        print("Median startup time", round(wall_median, 3), "is above the limit of", args.max_seconds, "seconds")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("Startup check passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import json
+import tempfile
+import stat
+import time
+import datetime
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Save the Drive access token between runs, so a short run does not pay for a new OAuth token exchange every time
+DRIVE_TOKEN_CACHE_ENABLED = os.getenv("DRIVE_TOKEN_CACHE_ENABLED", "false").lower() == "true"
+DRIVE_TOKEN_CACHE_FILE = os.getenv("DRIVE_TOKEN_CACHE_FILE", "drive_token_cache.json")
+
+# A cached token with less than this many seconds left is replaced with a new one instead of being used
+DRIVE_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("DRIVE_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+
+_lock = threading.Lock()
+
+# Tokens are stored per service account and scopes, so switching accounts never reuses the wrong token
+def make_token_key(account_email, scopes):
+    return account_email + " " + " ".join(sorted(scopes or []))
+
+# The cache holds live access tokens, so only trust a file that nobody else can read or write
+def cache_file_is_private(path):
+    if os.name != 'posix':
+        return True
+    file_stat = os.stat(path)
+    if file_stat.st_uid != os.getuid():
+        print("Token cache file is owned by another user. Not using it")
+        return False
+    if file_stat.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        print("Token cache file can be read by other users. Not using it")
+        return False
+    return True
+
+# Read every cached token. Returns an empty dict if there is no usable cache file
+def read_token_cache():
+    if not os.path.exists(DRIVE_TOKEN_CACHE_FILE) or not cache_file_is_private(DRIVE_TOKEN_CACHE_FILE):
+        return {}
+    try:
+        with open(DRIVE_TOKEN_CACHE_FILE, 'r', encoding='utf-8') as cache_file:
+            tokens = json.load(cache_file)
+        return tokens if isinstance(tokens, dict) else {}
+    except Exception as e:
+        print("Error reading token cache:", e)
+        return {}
+
+# Returns the cached token and its expiry (a naive UTC datetime, like google-auth uses), or None if there is no token
+# with at least DRIVE_TOKEN_REFRESH_MARGIN_SECONDS left
+def load_cached_token(account_email, scopes):
+    with _lock:
+        entry = read_token_cache().get(make_token_key(account_email, scopes))
+    if entry is None:
+        return None
+    if entry.get('expires_at', 0) - time.time() < DRIVE_TOKEN_REFRESH_MARGIN_SECONDS:
+        return None
+    expiry = datetime.datetime.fromtimestamp(entry['expires_at'], datetime.timezone.utc).replace(tzinfo=None)
+    return entry['token'], expiry
+
+# Save a token. The file is created with owner-only permissions and replaced in one step
+def save_cached_token(account_email, scopes, token, expiry):
+    if token is None or expiry is None:
+        return
+    expires_at = expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+    with _lock:
+        try:
+            tokens = read_token_cache()
+            # Drop tokens that have already run out
+            tokens = {key: entry for key, entry in tokens.items() if entry.get('expires_at', 0) > time.time()}
+            tokens[make_token_key(account_email, scopes)] = {'token': token, 'expires_at': expires_at}
+
+            # Every save gets its own temp file, so several watcher instances can save at once. mkstemp creates it
+            # with owner-only permissions
+            directory = os.path.dirname(DRIVE_TOKEN_CACHE_FILE) or '.'
+            file_descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(DRIVE_TOKEN_CACHE_FILE) + '.', suffix='.tmp')
+            try:
+                with os.fdopen(file_descriptor, 'w', encoding='utf-8') as cache_file:
+                    json.dump(tokens, cache_file)
+                os.replace(temp_path, DRIVE_TOKEN_CACHE_FILE)
+            except BaseException:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+                raise
+        except Exception as e:
+            print("Error saving token cache:", e)
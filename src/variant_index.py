@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import time
+import sqlite3
+from image_preprocessor import pillow_source
+from dotenv import load_dotenv
+
+# Pillow is needed to hash images. Without it every product gets its own GPT call
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# One painting is often listed several times (the original and prints in different sizes) with nearly the same photo.
+# With this on, a product whose main image looks like one we already wrote a listing for reuses that listing,
+# with the size and art type swapped in, instead of calling GPT again
+VARIANT_REUSE_ENABLED = os.getenv("VARIANT_REUSE_ENABLED", "false").lower() == "true"
+VARIANT_INDEX_FILE = os.getenv("VARIANT_INDEX_FILE", "variant_index.db")
+
+# How many of the 64 hash bits may differ for two images to count as the same painting
+VARIANT_HASH_MAX_DISTANCE = int(os.getenv("VARIANT_HASH_MAX_DISTANCE", "6"))
+
+# An original and a print need different wording (materials, one of a kind, care), so by default a listing is only
+# reused for products of the same art type
+VARIANT_REUSE_ACROSS_ART_TYPES = os.getenv("VARIANT_REUSE_ACROSS_ART_TYPES", "false").lower() == "true"
+
+# The folder name says which painting a product is, so by default a listing is only reused for a product with the same
+# painting title. Two different paintings can still have close hashes, and then one would get the other's description
+VARIANT_REUSE_ACROSS_TITLES = os.getenv("VARIANT_REUSE_ACROSS_TITLES", "false").lower() == "true"
+
+# Open the index and create the table the first time
+def open_index():
+    connection = sqlite3.connect(VARIANT_INDEX_FILE, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS listings (
+            image_hash TEXT NOT NULL,
+            product_info TEXT NOT NULL,
+            listing_data TEXT NOT NULL,
+            created_at REAL
+        )
+    """)
+    return connection
+
+# 64-bit difference hash of an image: shrink it to 9x8 grey pixels and note whether each pixel is brighter than
+# its right neighbour. Resized, recompressed or slightly retouched copies get the same or a very close hash.
+# Returns the hash as 16 hex characters, or None if Pillow is missing or the image can not be read
+def compute_image_hash(image_source):
+    if Image is None:
+        return None
+    try:
+        with Image.open(pillow_source(image_source)) as image:
+            # JPEGs can be decoded at a fraction of their size, which is all a 9x8 hash needs
+            image.draft('L', (64, 64))
+            image = ImageOps.exif_transpose(image)
+            small = image.convert('L').resize((9, 8), Image.LANCZOS)
+        pixels = list(small.getdata())
+        value = 0
+        for row in range(8):
+            for column in range(8):
+                left = pixels[row * 9 + column]
+                right = pixels[row * 9 + column + 1]
+                value = (value << 1) | (1 if left > right else 0)
+        return f"{value:016x}"
+    except Exception as e:
+        print("Error in compute_image_hash:", e)
+        return None
+
+# Number of bits that differ between two hashes
+def hash_distance(first_hash, second_hash):
+    return bin(int(first_hash, 16) ^ int(second_hash, 16)).count('1')
+
+# True if a listing written for source_info may be reused for target_info
+def can_reuse_for(source_info, target_info):
+    if not VARIANT_REUSE_ACROSS_TITLES and source_info.get('painting_title', '').strip().lower() != target_info.get('painting_title', '').strip().lower():
+        return False
+    if not VARIANT_REUSE_ACROSS_ART_TYPES and source_info.get('art_type', '').lower() != target_info.get('art_type', '').lower():
+        return False
+    # Without both sizes there is nothing to swap, so the listing would describe the wrong size
+    if source_info.get('size') != target_info.get('size') and 'Unknown' in (source_info.get('size'), target_info.get('size')):
+        return False
+    return True
+
+# Find the closest earlier listing for an image hash that can be reused for this product.
+# Returns its listing data and the product info it was written for, or (None, None)
+def find_similar_listing(image_hash, product_info):
+    connection = open_index()
+    try:
+        best = None
+        best_distance = VARIANT_HASH_MAX_DISTANCE + 1
+        for row in connection.execute("SELECT image_hash, product_info, listing_data FROM listings"):
+            distance = hash_distance(image_hash, row['image_hash'])
+            if distance >= best_distance:
+                continue
+            source_info = json.loads(row['product_info'])
+            if can_reuse_for(source_info, product_info):
+                best = (json.loads(row['listing_data']), source_info)
+                best_distance = distance
+        if best is None:
+            return None, None
+        print("Found a listing for a variant of this painting. Hash distance:", best_distance)
+        return best
+    finally:
+        connection.close()
+
+# Remember a listing GPT wrote, so variants of the same painting can reuse it
+def save_listing_hash(image_hash, product_info, listing_data):
+    connection = open_index()
+    try:
+        with connection:
+            connection.execute("INSERT INTO listings (image_hash, product_info, listing_data, created_at) VALUES (?, ?, ?, ?)",
+                               (image_hash, json.dumps(product_info), json.dumps(listing_data), time.time()))
+    except Exception as e:
+        print("Error in save_listing_hash:", e)
+    finally:
+        connection.close()
+
+# Pattern that finds a size in text. "16x20" also matches "16 x 20" and "16×20", but not "116x20", "16x200" or "16x20.5".
+# A full stop right after the size still matches, since it usually just ends the sentence
+def size_pattern(size):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*[xX×]\s*(\d+(?:\.\d+)?)\s*', size)
+    if match:
+        return re.compile(r'(?<![\d.])' + re.escape(match.group(1)) + r'\s*[xX×]\s*' + re.escape(match.group(2)) + r'(?!\.?\d)')
+    return re.compile(re.escape(size), re.IGNORECASE)
+
+# Replace every match with new, keeping the case of what was there (print -> original, Print -> Original)
+def replace_matching_case(pattern, new, text):
+    def replacement(match):
+        found = match.group(0)
+        if found.isupper() and len(found) > 1:
+            return new.upper()
+        if found[:1].isupper():
+            return new[:1].upper() + new[1:]
+        if found.islower():
+            return new.lower()
+        return new
+    return pattern.sub(replacement, text)
+
+# Swap the size and art type of the product a listing was written for with those of the new product
+def swap_variant_details(text, source_info, target_info):
+    source_size, target_size = source_info.get('size', ''), target_info.get('size', '')
+    if source_size and target_size and source_size != target_size:
+        text = size_pattern(source_size).sub(target_size, text)
+    source_type, target_type = source_info.get('art_type', ''), target_info.get('art_type', '')
+    if source_type and target_type and source_type.lower() != target_type.lower():
+        text = replace_matching_case(re.compile(r'\b' + re.escape(source_type) + r'\b', re.IGNORECASE), target_type, text)
+    return text
+
+# Make a listing written for source_info fit target_info. The title is cut back to 140 characters at a word if needed
+def adapt_listing_to_variant(listing_data, source_info, target_info):
+    title = swap_variant_details(listing_data['title'], source_info, target_info)
+    if len(title) > 140:
+        title = title[:141].rsplit(' ', 1)[0].rstrip(' ,-|')
+    tags = []
+    for tag in listing_data['tags']:
+        tag = swap_variant_details(tag, source_info, target_info)
+        if tag.lower() not in [existing.lower() for existing in tags]:
+            tags.append(tag)
+    adapted = dict(listing_data)
+    adapted['title'] = title
+    adapted['description'] = swap_variant_details(listing_data['description'], source_info, target_info)
+    adapted['tags'] = tags
+    return adapted
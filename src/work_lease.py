@@ -0,0 +1,204 @@
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+from drive_authentication import get_shared_drive_service
+from dotenv import load_dotenv
+
+# Load environment variables from env file
+load_dotenv('config.env')
+
+# Lets several drive_watcher processes work on the same Unprocessed folder. Before a product folder is processed it is
+# leased to one instance, and the others skip it. "none" turns leasing off (one instance only),
+# "local" keeps leases in a SQLite file that every instance can reach (same machine or a shared disk),
+# "drive" writes them into the folder's appProperties on Drive, so instances on different machines see them
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "none").lower()
+LEASE_FILE = os.getenv("LEASE_FILE", "leases.db")
+
+# A lease runs out after this many seconds unless it is renewed, so a folder held by a crashed instance is picked up again.
+# Held leases are renewed in the background a few times per lease period
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", "600"))
+
+# Drive has no compare-and-set for appProperties, so a claim is written, then read back after this many seconds.
+# If two instances wrote at the same time only the last one still sees itself as the owner
+LEASE_SETTLE_SECONDS = float(os.getenv("LEASE_SETTLE_SECONDS", "2"))
+
+# Name this instance writes into its leases. Must be different for every running instance
+LEASE_OWNER = os.getenv("LEASE_OWNER") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Leases in a SQLite file. A claim reads and writes inside one write transaction, so only one instance can win it
+class LocalLeaseBackend:
+    def __init__(self, lease_file=LEASE_FILE):
+        self.lease_file = lease_file
+
+    def open(self):
+        connection = sqlite3.connect(self.lease_file, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                product_folder_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        return connection
+
+    def claim(self, product_folder_id, owner, expires_at):
+        connection = self.open()
+        try:
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                row = connection.execute("SELECT owner, expires_at FROM leases WHERE product_folder_id = ?", (product_folder_id,)).fetchone()
+                if row is not None and row['owner'] != owner and row['expires_at'] > time.time():
+                    return False
+                connection.execute("""
+                    INSERT INTO leases (product_folder_id, owner, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(product_folder_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                """, (product_folder_id, owner, expires_at))
+                return True
+        finally:
+            connection.close()
+
+    # Extend a lease we hold. Returns False if it was lost to another instance in the meantime
+    def renew(self, product_folder_id, owner, expires_at):
+        connection = self.open()
+        try:
+            with connection:
+                cursor = connection.execute("UPDATE leases SET expires_at = ? WHERE product_folder_id = ? AND owner = ?",
+                                            (expires_at, product_folder_id, owner))
+                return cursor.rowcount == 1
+        finally:
+            connection.close()
+
+    def release(self, product_folder_id, owner):
+        connection = self.open()
+        try:
+            with connection:
+                connection.execute("DELETE FROM leases WHERE product_folder_id = ? AND owner = ?", (product_folder_id, owner))
+        finally:
+            connection.close()
+
+# When this instance last wrote a lease into each product folder's appProperties. Drive reports those writes in its
+# changes feed like any other change, so the daemon uses this to tell them apart from real changes
+_lease_writes = {}
+_lease_writes_lock = threading.Lock()
+
+# Product folder IDs this instance wrote a lease into at or after the given time. Older entries are dropped
+def lease_writes_since(since):
+    with _lease_writes_lock:
+        for product_folder_id in [folder_id for folder_id, written_at in _lease_writes.items() if written_at < since]:
+            del _lease_writes[product_folder_id]
+        return set(_lease_writes)
+
+# Leases in the product folder's appProperties (leaseOwner and leaseExpires), written with the shared Drive service
+class DriveLeaseBackend:
+    def read_lease(self, product_folder_id):
+        folder = get_shared_drive_service().files().get(fileId=product_folder_id, fields='appProperties').execute()
+        app_properties = folder.get('appProperties') or {}
+        return app_properties.get('leaseOwner'), float(app_properties.get('leaseExpires') or 0)
+
+    def write_lease(self, product_folder_id, owner, expires_at):
+        app_properties = {'leaseOwner': owner, 'leaseExpires': str(expires_at) if expires_at is not None else None}
+        with _lease_writes_lock:
+            _lease_writes[product_folder_id] = time.time()
+        get_shared_drive_service().files().update(fileId=product_folder_id, body={'appProperties': app_properties}, fields='id').execute()
+
+    def claim(self, product_folder_id, owner, expires_at):
+        lease_owner, lease_expires = self.read_lease(product_folder_id)
+        if lease_owner is not None and lease_owner != owner and lease_expires > time.time():
+            return False
+        self.write_lease(product_folder_id, owner, expires_at)
+        time.sleep(LEASE_SETTLE_SECONDS)
+        lease_owner, lease_expires = self.read_lease(product_folder_id)
+        return lease_owner == owner
+
+    def renew(self, product_folder_id, owner, expires_at):
+        lease_owner, lease_expires = self.read_lease(product_folder_id)
+        if lease_owner != owner:
+            return False
+        self.write_lease(product_folder_id, owner, expires_at)
+        return True
+
+    def release(self, product_folder_id, owner):
+        lease_owner, lease_expires = self.read_lease(product_folder_id)
+        if lease_owner == owner:
+            # Setting an appProperty to None deletes it
+            self.write_lease(product_folder_id, None, None)
+
+# Product folder IDs this instance holds a lease on
+_held_leases = set()
+_held_leases_lock = threading.Lock()
+_renewer_started = False
+
+# The configured lease backend, or None when leasing is off
+def get_lease_backend():
+    if LEASE_BACKEND == "local":
+        return LocalLeaseBackend()
+    if LEASE_BACKEND == "drive":
+        return DriveLeaseBackend()
+    return None
+
+# Renew every held lease until the process ends. A lease that was lost is dropped, and the product finishes anyway
+def renew_held_leases():
+    backend = get_lease_backend()
+    while True:
+        time.sleep(LEASE_SECONDS / 3)
+        with _held_leases_lock:
+            held = list(_held_leases)
+        for product_folder_id in held:
+            try:
+                if not backend.renew(product_folder_id, LEASE_OWNER, time.time() + LEASE_SECONDS):
+                    print("Lease was taken over by another instance:", product_folder_id)
+                    with _held_leases_lock:
+                        _held_leases.discard(product_folder_id)
+            except Exception as e:
+                print("Error renewing lease:", e)
+
+def start_renewer():
+    global _renewer_started
+    with _held_leases_lock:
+        if _renewer_started:
+            return
+        _renewer_started = True
+    threading.Thread(target=renew_held_leases, name="lease-renewer", daemon=True).start()
+
+# Order in which this instance tries the product folders. Every instance gets a different order,
+# so they start on different folders instead of all racing for the first one
+def claim_order(image_files):
+    if get_lease_backend() is None:
+        return list(image_files)
+    return sorted(image_files, key=lambda image_file: hashlib.sha1((LEASE_OWNER + image_file['product_folder_id']).encode('utf-8')).hexdigest())
+
+# Take the lease on a product folder. Returns True if this instance may process it.
+# Always True when leasing is off. Claiming a folder this instance already holds succeeds
+def claim_product(image_file):
+    backend = get_lease_backend()
+    if backend is None:
+        return True
+    product_folder_id = image_file['product_folder_id']
+    try:
+        if not backend.claim(product_folder_id, LEASE_OWNER, time.time() + LEASE_SECONDS):
+            print("Product folder is leased by another instance:", image_file.get('product_folder_name'))
+            return False
+    except Exception as e:
+        print("Error in claim_product:", e)
+        return False
+    with _held_leases_lock:
+        _held_leases.add(product_folder_id)
+    start_renewer()
+    return True
+
+# Give up the lease on a product folder, so another instance can pick it up if it is still in Unprocessed
+def release_product(image_file):
+    backend = get_lease_backend()
+    if backend is None:
+        return
+    product_folder_id = image_file['product_folder_id']
+    with _held_leases_lock:
+        _held_leases.discard(product_folder_id)
+    try:
+        backend.release(product_folder_id, LEASE_OWNER)
+    except Exception as e:
+        print("Error in release_product:", e)